@@ -1,4 +1,7 @@
+import os
 from datetime import datetime, timedelta, timezone
+from functools import cached_property
+from typing import Literal
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -9,6 +12,32 @@ class Settings(BaseSettings):
     db_path: str = "data/quota_bot.db"
     tz_offset: int = 3  # UTC+3 (Москва)
 
+    # Профиль PRAGMA SQLite — применяется к каждому новому соединению.
+    # WAL позволяет читателям (статистика, выгрузки) не блокировать запись и наоборот
+    sqlite_journal_mode: Literal["WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY"] = "WAL"
+    sqlite_synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    sqlite_cache_size: int = -20000  # отрицательное значение — в КиБ (≈20 МБ на соединение)
+    sqlite_mmap_size: int = 128 * 1024 * 1024
+    sqlite_temp_store: Literal["DEFAULT", "FILE", "MEMORY"] = "MEMORY"
+    sqlite_busy_timeout: int = 15000  # мс
+    sqlite_read_pool_size: int = 2  # соединений у read-only движка для отчётов
+
+    # Кэш пользователей в AuthMiddleware
+    user_cache_size: int = 1000
+    user_cache_ttl: int = 300  # секунд
+    # Как часто сверять кэш лимитов квот с таблицей quotas
+    quota_verify_interval: int = 300  # секунд
+
+    # Выгрузки: книга рендерится вне event loop — в пуле потоков или процессов.
+    # export_workers — и размер пула, и сколько выгрузок может идти одновременно
+    export_executor: Literal["thread", "process"] = "thread"
+    export_workers: int = 2
+    export_queue_size: int = 10  # выгрузок в очереди сверх выполняемых
+    # Telegram принимает от бота документы до 50 МБ — CSV режется на части меньше этого
+    export_part_max_bytes: int = 45 * 1024 * 1024
+    # Кэш готовых отчётов на диске рядом с БД (data/reports), вытеснение по LRU
+    report_cache_max_bytes: int = 256 * 1024 * 1024
+
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
@@ -18,6 +47,26 @@ class Settings(BaseSettings):
     def admin_id_list(self) -> list[int]:
         return [int(x.strip()) for x in self.admin_ids.split(",") if x.strip()]
 
+    @property
+    def report_cache_dir(self) -> str:
+        return os.path.join(os.path.dirname(self.db_path), "reports")
+
+    @cached_property
+    def admin_id_set(self) -> frozenset[int]:
+        """admin_id_list, разобранный один раз — для проверки на каждом апдейте."""
+        return frozenset(self.admin_id_list)
+
+    @property
+    def sqlite_pragmas(self) -> dict[str, str | int]:
+        return {
+            "journal_mode": self.sqlite_journal_mode,
+            "synchronous": self.sqlite_synchronous,
+            "cache_size": self.sqlite_cache_size,
+            "mmap_size": self.sqlite_mmap_size,
+            "temp_store": self.sqlite_temp_store,
+            "busy_timeout": self.sqlite_busy_timeout,
+        }
+
 
 settings = Settings()
 
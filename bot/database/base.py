@@ -1,9 +1,10 @@
 import os
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncGenerator, Callable
 
 from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session, SessionTransaction
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from bot.config import settings
 
@@ -12,28 +13,52 @@ class Base(DeclarativeBase):
     pass
 
 
-def _make_engine():
+# Эти PRAGMA меняют файл БД, поэтому на read-only соединениях их не выставляем
+_WRITE_ONLY_PRAGMAS = ("journal_mode", "synchronous")
+
+
+def _make_engine(read_only: bool = False):
     db_path = settings.db_path
     db_dir = os.path.dirname(db_path)
     if db_dir:
         os.makedirs(db_dir, exist_ok=True)
-    engine = create_async_engine(
-        f"sqlite+aiosqlite:///{db_path}",
-        echo=False,
-        connect_args={"check_same_thread": False, "timeout": 15},
-    )
+    if read_only:
+        # Отдельный маленький пул для отчётов: mode=ro на уровне файла + query_only.
+        # aiosqlite по умолчанию берёт NullPool, поэтому пул задаём явно
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///file:{db_path}?mode=ro&uri=true",
+            echo=False,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=settings.sqlite_read_pool_size,
+            max_overflow=0,
+            connect_args={"check_same_thread": False, "timeout": settings.sqlite_busy_timeout / 1000},
+        )
+    else:
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{db_path}",
+            echo=False,
+            connect_args={"check_same_thread": False, "timeout": settings.sqlite_busy_timeout / 1000},
+        )
 
-    # SQLite по умолчанию не соблюдает foreign keys — включаем явно
+    # SQLite по умолчанию не соблюдает foreign keys — включаем явно;
+    # остальные PRAGMA берутся из профиля в настройках
     @event.listens_for(engine.sync_engine, "connect")
     def set_sqlite_pragma(dbapi_conn, _connection_record):
         cursor = dbapi_conn.cursor()
         cursor.execute("PRAGMA foreign_keys=ON")
+        for name, value in settings.sqlite_pragmas.items():
+            if read_only and name in _WRITE_ONLY_PRAGMAS:
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
         cursor.close()
 
     return engine
 
 
 engine = _make_engine()
+read_engine = _make_engine(read_only=True)
 
 AsyncSessionLocal = async_sessionmaker(
     bind=engine,
@@ -42,19 +67,232 @@ AsyncSessionLocal = async_sessionmaker(
     autoflush=False,
 )
 
+# Сессии только для чтения: статистика, история возвратов, выгрузки
+ReadSessionLocal = async_sessionmaker(
+    bind=read_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+    autoflush=False,
+)
+
+
+class LazySession:
+    """
+    Прокси над AsyncSession: сессия создаётся при первом обращении к ней.
+    Апдейты, которым БД не нужна (noop, отмена, навигация по меню, отказ валидации),
+    не создают сессию и не делают commit/rollback.
+    """
+
+    def __init__(self, factory: async_sessionmaker[AsyncSession]) -> None:
+        self._factory = factory
+        self._session: AsyncSession | None = None
+
+    def __getattr__(self, name: str):
+        if self._session is None:
+            self._session = self._factory()
+        return getattr(self._session, name)
+
+    def in_transaction(self) -> bool:
+        return self._session is not None and self._session.in_transaction()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+_AFTER_COMMIT = "after_commit_callbacks"
+
+
+def on_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """
+    Выполнить callback после commit транзакции сессии; при откате он отбрасывается.
+    Кэши процесса (пользователи, лимиты квот) меняем только так: до commit параллельный
+    апдейт прочитал бы из БД старое состояние и снова положил его в кэш.
+    """
+    session.sync_session.info.setdefault(_AFTER_COMMIT, []).append(callback)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session: Session) -> None:
+    for callback in session.info.pop(_AFTER_COMMIT, []):
+        callback()
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_after_commit(session: Session, transaction: SessionTransaction) -> None:
+    # После commit список уже пуст; непустой — транзакцию откатили
+    if transaction.parent is None:
+        session.info.pop(_AFTER_COMMIT, None)
+
 
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with AsyncSessionLocal() as session:
         yield session
 
 
+async def get_pragma_report() -> dict[str, str | int]:
+    """Фактические значения PRAGMA на соединении из пула (для лога при старте)."""
+    report: dict[str, str | int] = {}
+    async with engine.connect() as conn:
+        for name in ("foreign_keys", *settings.sqlite_pragmas):
+            result = await conn.execute(text(f"PRAGMA {name}"))
+            report[name] = result.scalar_one()
+    return report
+
+
+def _create_missing_indexes(sync_conn) -> None:
+    existing = {
+        row[0]
+        for row in sync_conn.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    }
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(sync_conn)
+
+
+# Индексы, которые убраны из моделей: ни один запрос их не выбирал
+_DROPPED_INDEXES = (
+    "ix_records_active_month_created",
+    # Дельта-выгрузка ищет по changed_seq, а не по created_at
+    "ix_records_created_at",
+)
+
+
+def _yo(expr: str) -> str:
+    # unicode61 не приравнивает ё к е — заменяем до индексации (и в запросе тоже)
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def _phone_digits(expr: str) -> str:
+    digits = expr
+    for ch in (" ", "-", "(", ")", "+"):
+        digits = f"replace({digits}, '{ch}', '')"
+    # Все цифры и последние десять: находится и «7900…», и «900…» без кода страны
+    return f"{digits} || ' ' || substr({digits}, -10)"
+
+
+# Полнотекстовый поиск админа (FTS5): rowid — telegram_id / records.id.
+# Таблицы хранят уже нормализованный текст и обновляются триггерами.
+# prefix — индексы начал токенов длиной 1–3: номера договоров вроде «12/4» дробятся
+# на короткие токены, и без них «4*» перебирал бы тысячи терминов.
+# Таблица → (DDL, заполнение по существующим строкам)
+_FTS_TABLES = {
+    "users_fts": (
+        "CREATE VIRTUAL TABLE users_fts USING fts5("
+        "full_name, phone, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3')",
+        f"INSERT INTO users_fts (rowid, full_name, phone) "
+        f"SELECT telegram_id, {_yo('full_name')}, {_phone_digits('phone')} FROM users",
+    ),
+    "records_fts": (
+        "CREATE VIRTUAL TABLE records_fts USING fts5("
+        "site_number, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3')",
+        f"INSERT INTO records_fts (rowid, site_number) SELECT id, {_yo('site_number')} FROM records",
+    ),
+}
+
+_FTS_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, full_name, phone)
+        VALUES (new.telegram_id, {_yo("new.full_name")}, {_phone_digits("new.phone")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF full_name, phone ON users BEGIN
+        UPDATE users_fts SET full_name = {_yo("new.full_name")}, phone = {_phone_digits("new.phone")}
+        WHERE rowid = new.telegram_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        DELETE FROM users_fts WHERE rowid = old.telegram_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS records_fts_insert AFTER INSERT ON records BEGIN
+        INSERT INTO records_fts (rowid, site_number) VALUES (new.id, {_yo("new.site_number")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS records_fts_update AFTER UPDATE OF site_number ON records BEGIN
+        UPDATE records_fts SET site_number = {_yo("new.site_number")} WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS records_fts_delete AFTER DELETE ON records BEGIN
+        DELETE FROM records_fts WHERE rowid = old.id;
+    END""",
+)
+
+
 async def init_db() -> None:
     from bot.database import models  # noqa: F401 — импорт нужен для регистрации моделей
 
     async with engine.begin() as conn:
+        result = await conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        existing_tables = {row[0] for row in result.fetchall()}
+
         await conn.run_sync(Base.metadata.create_all)
         # Миграция: добавить cancelled_at если колонки ещё нет (для существующих БД)
         result = await conn.execute(text("PRAGMA table_info(records)"))
         columns = [row[1] for row in result.fetchall()]
         if "cancelled_at" not in columns:
             await conn.execute(text("ALTER TABLE records ADD COLUMN cancelled_at DATETIME"))
+        # Миграция: search_name для поиска сотрудников (до создания индекса по нему)
+        result = await conn.execute(text("PRAGMA table_info(users)"))
+        if "search_name" not in [row[1] for row in result.fetchall()]:
+            await conn.execute(text("ALTER TABLE users ADD COLUMN search_name VARCHAR(100) NOT NULL DEFAULT ''"))
+            result = await conn.execute(text("SELECT telegram_id, full_name FROM users"))
+            rows = [
+                {"id": telegram_id, "key": models.name_search_key(full_name)}
+                for telegram_id, full_name in result.fetchall()
+            ]
+            if rows:
+                await conn.execute(text("UPDATE users SET search_name = :key WHERE telegram_id = :id"), rows)
+        # Миграция: changed_seq для дельта-выгрузки (до создания индекса по нему).
+        # Старые записи нумеруются по времени последнего изменения
+        if "changed_seq" not in columns:
+            await conn.execute(text("ALTER TABLE records ADD COLUMN changed_seq INTEGER NOT NULL DEFAULT 0"))
+            await conn.execute(text(
+                "UPDATE records SET changed_seq = numbered.seq FROM ("
+                "SELECT id, row_number() OVER (ORDER BY coalesce(cancelled_at, created_at), id) AS seq "
+                "FROM records) AS numbered WHERE numbered.id = records.id"
+            ))
+        # Миграция: отметки дельта-выгрузки по времени → по changed_seq. Отметка ставится
+        # перед первой записью, которую старая выгрузка не отдала, — лучше прислать
+        # изменение повторно, чем потерять. Возвраты без даты (из старых БД) старая
+        # выгрузка отдавала каждый раз, пока не было отметки по возвратам, — они уже у админа
+        result = await conn.execute(text("PRAGMA table_info(export_marks)"))
+        if "last_seq" not in [row[1] for row in result.fetchall()]:
+            await conn.execute(text("ALTER TABLE export_marks ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0"))
+            await conn.execute(text(
+                "UPDATE export_marks SET last_seq = coalesce(("
+                "SELECT min(changed_seq) - 1 FROM records "
+                "WHERE export_marks.last_created_at IS NULL "
+                "OR records.created_at > export_marks.last_created_at "
+                "OR (records.cancelled_at IS NOT NULL AND (export_marks.last_cancelled_at IS NULL "
+                "OR records.cancelled_at > export_marks.last_cancelled_at))"
+                "), (SELECT coalesce(max(changed_seq), 0) FROM records))"
+            ))
+            await conn.execute(text("ALTER TABLE export_marks DROP COLUMN last_created_at"))
+            await conn.execute(text("ALTER TABLE export_marks DROP COLUMN last_cancelled_at"))
+        # Миграция: create_all не добавляет индексы к уже существующим таблицам
+        await conn.run_sync(_create_missing_indexes)
+        for name in _DROPPED_INDEXES:
+            await conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        # Миграция: заполнить monthly_rollups по уже существующим записям;
+        # заменённая ею таблица usage_counters больше не нужна
+        if "monthly_rollups" not in existing_tables:
+            await conn.execute(text(
+                "INSERT INTO monthly_rollups (month, user_id, active, returned) "
+                "SELECT month, user_id, SUM(is_cancelled = 0), SUM(is_cancelled = 1) FROM records "
+                "GROUP BY month, user_id"
+            ))
+        await conn.execute(text("DROP TABLE IF EXISTS usage_counters"))
+        # Миграция: поисковые FTS-таблицы и триггеры. Таблица, которой нет или у которой
+        # изменились настройки (DDL в sqlite_master другой), создаётся заново и заполняется
+        result = await conn.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'table'"))
+        table_sql = dict(result.tuples().all())
+        for name, (create, backfill) in _FTS_TABLES.items():
+            if table_sql.get(name) != create:
+                await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                await conn.execute(text(create))
+                await conn.execute(text(backfill))
+        for statement in _FTS_TRIGGERS:
+            await conn.execute(text(statement))
+        # Без статистики планировщик SQLite может выбрать не тот частичный индекс.
+        # analysis_limit ограничивает ANALYZE выборкой, чтобы старт оставался быстрым
+        await conn.execute(text("PRAGMA analysis_limit=1000"))
+        await conn.execute(text("ANALYZE"))
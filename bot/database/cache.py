@@ -0,0 +1,163 @@
+import time
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
+
+from bot.config import settings
+from bot.database.models import User
+
+# Маркер промаха: отличает «нет в кэше» от закэшированного None
+MISSING: Any = object()
+
+
+class LruTtlCache:
+    """
+    Ограниченный кэш в памяти процесса: вытеснение по LRU и время жизни записи.
+    Ведёт счётчики попаданий/промахов, чтобы было видно, сколько запросов к БД он экономит.
+    version растёт при каждом сбросе: значение, прочитанное из БД до сброса, в кэш не попадёт.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, version: int | None = None) -> None:
+        """version — self.version на момент чтения value из БД; если с тех пор был сброс, не кэшируем."""
+        if version is not None and version != self.version:
+            return
+        self._data[key] = (time.monotonic() + self._ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+        self.version += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.version += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    """Лёгкая копия User для кэша: не привязана к сессии и не становится expired."""
+
+    telegram_id: int
+    full_name: str
+    phone: str
+    role: str
+    is_admin: bool
+    created_at: datetime | None
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserSnapshot":
+        return cls(
+            telegram_id=user.telegram_id,
+            full_name=user.full_name,
+            phone=user.phone,
+            role=user.role,
+            is_admin=user.is_admin,
+            created_at=user.created_at,
+        )
+
+
+class QuotaResolver:
+    """
+    Все лимиты квот в памяти процесса: по ролям и персональные.
+    Загружается при старте после seed_defaults, обновляется методами QuotaRepo
+    и отвечает на get_limit без запросов к БД. take() по-прежнему проверяет
+    лимит в самом INSERT, поэтому устаревший кэш не может привести к перерасходу.
+    """
+
+    def __init__(self) -> None:
+        self._roles: dict[str, int] = {}
+        self._personal: dict[int, int] = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.version = 0  # растёт при каждом изменении — см. QuotaRepo.verify_cache
+
+    @staticmethod
+    def _split(rows: Iterable[tuple[str | None, int | None, int]]) -> tuple[dict[str, int], dict[int, int]]:
+        roles: dict[str, int] = {}
+        personal: dict[int, int] = {}
+        for role, user_id, limit in rows:
+            if user_id is not None:
+                personal[user_id] = limit
+            elif role is not None:
+                roles[role] = limit
+        return roles, personal
+
+    def load(self, rows: Iterable[tuple[str | None, int | None, int]]) -> None:
+        """rows — (role, user_id, monthly_limit) для всех строк таблицы quotas."""
+        self._roles, self._personal = self._split(rows)
+        self.loaded = True
+        self.version += 1
+
+    def matches(self, rows: Iterable[tuple[str | None, int | None, int]]) -> bool:
+        return self._split(rows) == (self._roles, self._personal)
+
+    def get_limit(self, user_id: int, role: str) -> int | None:
+        """Персональная → по роли; None если лимит не задан, MISSING если кэш не загружен."""
+        if not self.loaded:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        limit = self._personal.get(user_id)
+        return limit if limit is not None else self._roles.get(role)
+
+    def get_personal(self, user_id: int) -> int | None:
+        return self._personal.get(user_id)
+
+    def set_role(self, role: str, limit: int) -> None:
+        self._roles[role] = limit
+        self.version += 1
+
+    def set_personal(self, user_id: int, limit: int) -> None:
+        self._personal[user_id] = limit
+        self.version += 1
+
+    def remove_personal(self, user_id: int) -> None:
+        self._personal.pop(user_id, None)
+        self.version += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._roles) + len(self._personal),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# telegram_id → UserSnapshot | None (None — пользователь не зарегистрирован)
+user_cache = LruTtlCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl)
+
+# Число зарегистрированных сотрудников для списков выбора; сбрасывается при регистрации и удалении
+user_count_cache = LruTtlCache(maxsize=1, ttl=settings.user_cache_ttl)
+
+quota_resolver = QuotaResolver()
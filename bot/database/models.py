@@ -9,6 +9,7 @@ from sqlalchemy import (
     Index,
     Integer,
     String,
+    text,
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -23,11 +24,21 @@ ROLE_LABELS = {
 }
 
 
+def name_search_key(name: str) -> str:
+    """
+    ФИО для поиска и сортировки: без регистра, ё → е. Считается в Python —
+    lower() в SQLite понимает только латиницу.
+    """
+    return " ".join(name.casefold().replace("ё", "е").split())[:100]
+
+
 class User(Base):
     __tablename__ = "users"
 
     telegram_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
     full_name: Mapped[str] = mapped_column(String(100))
+    # name_search_key(full_name): алфавитный порядок списков выбора — по ix_users_search_name
+    search_name: Mapped[str] = mapped_column(String(100), default="")
     phone: Mapped[str] = mapped_column(String(20))
     role: Mapped[str] = mapped_column(String(20))
     is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
@@ -42,6 +53,11 @@ class User(Base):
         back_populates="user", lazy="select", cascade="all, delete-orphan"
     )
 
+    __table_args__ = (
+        # Списки выбора сотрудника: страницы по порядку имени и поиск по началу ФИО
+        Index("ix_users_search_name", "search_name", "telegram_id"),
+    )
+
 
 class Quota(Base):
     __tablename__ = "quotas"
@@ -79,10 +95,77 @@ class Record(Base):
     month: Mapped[str] = mapped_column(String(7))  # "2026-02"
     is_cancelled: Mapped[bool] = mapped_column(Boolean, default=False)
     cancelled_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # Номер последнего изменения записи (выдача, возврат) — растёт в порядке commit,
+    # по нему дельта-выгрузка находит изменения после отметки. См. RecordRepo.next_change_seq
+    changed_seq: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
 
     user: Mapped["User"] = relationship(back_populates="records")
 
     __table_args__ = (
+        # Планы запросов к records проверяет tests/test_query_plans.py: индекс,
+        # которым не пользуется ни один запрос, только замедляет запись
         Index("ix_records_user_month", "user_id", "month"),
+        # «🔎 Поиск»: точное совпадение номера договора за все месяцы
         Index("ix_records_site_number", "site_number"),
+        Index("ix_records_month_created", "month", "created_at"),
+        # Дельта-выгрузка: изменения после отметки — диапазон по этому индексу
+        Index("ix_records_changed_seq", "changed_seq"),
+        # Частичные индексы: почти все запросы смотрят только на активные записи
+        # (или только на возвраты), поэтому условие входит в сам индекс
+        Index(
+            "ix_records_active_user_month", "user_id", "month", "site_number",
+            sqlite_where=text("is_cancelled = 0"),
+        ),
+        Index(
+            "ix_records_active_user_created", "user_id", "created_at",
+            sqlite_where=text("is_cancelled = 0"),
+        ),
+        Index(
+            "ix_records_active_month_site", "month", "site_number",
+            sqlite_where=text("is_cancelled = 0"),
+        ),
+        Index(
+            "ix_records_cancelled_at", "cancelled_at", "month",
+            sqlite_where=text("is_cancelled = 1"),
+        ),
+    )
+
+
+class MonthlyRollup(Base):
+    """
+    Итоги сотрудника за месяц: активные записи и возвраты. Обновляется в той же
+    транзакции, что и records, — по ней проверяется квота, строится список
+    месяцев и итоги статистики без обхода records.
+    """
+
+    __tablename__ = "monthly_rollups"
+
+    month: Mapped[str] = mapped_column(String(7), primary_key=True)  # "2026-02"
+    user_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("users.telegram_id", ondelete="CASCADE"), primary_key=True
     )
+    active: Mapped[int] = mapped_column(Integer, default=0)
+    returned: Mapped[int] = mapped_column(Integer, default=0)
+
+    __table_args__ = (
+        # Первичный ключ (month, user_id) — для периодов; этот — для итогов сотрудника
+        Index("ix_monthly_rollups_user_month", "user_id", "month", "active"),
+    )
+
+
+class MonthVersion(Base):
+    """Версия данных месяца: растёт при каждой выдаче/возврате — ключ кэша отчётов."""
+
+    __tablename__ = "month_versions"
+
+    month: Mapped[str] = mapped_column(String(7), primary_key=True)  # "2026-02"
+    version: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class ExportMark(Base):
+    """Отметка последней дельта-выгрузки админа: до какого records.changed_seq он уже получил данные."""
+
+    __tablename__ = "export_marks"
+
+    admin_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    last_seq: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
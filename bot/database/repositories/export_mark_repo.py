@@ -0,0 +1,26 @@
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.database.models import ExportMark
+
+
+class ExportMarkRepo:
+    def __init__(self, session: AsyncSession) -> None:
+        self._session = session
+
+    async def get(self, admin_id: int) -> ExportMark | None:
+        result = await self._session.execute(
+            select(ExportMark).where(ExportMark.admin_id == admin_id)
+        )
+        return result.scalar_one_or_none()
+
+    async def advance(self, admin_id: int, last_seq: int) -> None:
+        """Сдвигает отметку вперёд до last_seq; назад она не двигается."""
+        stmt = sqlite_insert(ExportMark).values(admin_id=admin_id, last_seq=last_seq)
+        await self._session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[ExportMark.admin_id],
+                set_={"last_seq": func.max(ExportMark.last_seq, stmt.excluded.last_seq)},
+            )
+        )
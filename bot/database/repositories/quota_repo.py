@@ -1,9 +1,13 @@
-from sqlalchemy import select, update
+from sqlalchemy import ColumnElement, Select, and_, func, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
-from bot.database.models import Quota
+from bot.database.base import on_commit
+from bot.database.cache import MISSING, quota_resolver
+from bot.database.models import MonthlyRollup, Quota, User
 
 DEFAULT_LIMIT = 5
+_IN_CHUNK = 900  # не упираемся в лимит переменных SQLite на старых сборках
 
 
 class QuotaRepo:
@@ -23,7 +27,10 @@ class QuotaRepo:
         return result.scalar_one_or_none()
 
     async def get_limit(self, user_id: int, role: str) -> int:
-        """Персональная квота имеет приоритет над ролевой."""
+        """Персональная квота имеет приоритет над ролевой. Отвечает из кэша, если он загружен."""
+        limit = quota_resolver.get_limit(user_id, role)
+        if limit is not MISSING:
+            return limit if limit is not None else DEFAULT_LIMIT
         personal = await self.get_personal(user_id)
         if personal is not None:
             return personal.monthly_limit
@@ -32,6 +39,76 @@ class QuotaRepo:
             return role_quota.monthly_limit
         return DEFAULT_LIMIT
 
+    @staticmethod
+    def limit_expr(user_id, role) -> ColumnElement[int]:
+        """
+        SQL-выражение лимита с тем же приоритетом, что и get_limit:
+        персональная → по роли → DEFAULT_LIMIT. Вычисляется на стороне БД,
+        поэтому его можно встраивать в запросы, которые пишут данные.
+        """
+        personal = (
+            select(Quota.monthly_limit)
+            .where(Quota.user_id == user_id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        by_role = (
+            select(Quota.monthly_limit)
+            .where(Quota.role == role, Quota.user_id.is_(None))
+            .limit(1)
+            .scalar_subquery()
+        )
+        return func.coalesce(personal, by_role, DEFAULT_LIMIT)
+
+    @staticmethod
+    def _status_select(month: str) -> Select:
+        """
+        (User, used, limit, personal_limit) для сотрудников одним запросом:
+        счётчик за месяц и обе квоты (персональная, по роли) через LEFT JOIN.
+        """
+        personal = aliased(Quota)
+        by_role = aliased(Quota)
+        used = func.coalesce(MonthlyRollup.active, 0)
+        limit = func.coalesce(personal.monthly_limit, by_role.monthly_limit, DEFAULT_LIMIT)
+        return (
+            select(
+                User,
+                used.label("used"),
+                limit.label("limit"),
+                personal.monthly_limit.label("personal_limit"),
+            )
+            .outerjoin(
+                MonthlyRollup,
+                and_(MonthlyRollup.month == month, MonthlyRollup.user_id == User.telegram_id),
+            )
+            .outerjoin(personal, personal.user_id == User.telegram_id)
+            .outerjoin(by_role, and_(by_role.role == User.role, by_role.user_id.is_(None)))
+        )
+
+    async def get_statuses(
+        self, user_ids: list[int], month: str
+    ) -> list[tuple[User, int, int, int | None]]:
+        """(User, used, limit, personal_limit) для списка сотрудников."""
+        rows: list[tuple[User, int, int, int | None]] = []
+        for start in range(0, len(user_ids), _IN_CHUNK):
+            chunk = user_ids[start:start + _IN_CHUNK]
+            result = await self._session.execute(
+                self._status_select(month).where(User.telegram_id.in_(chunk))
+            )
+            rows.extend(tuple(row) for row in result.all())
+        return rows
+
+    async def get_near_limit(
+        self, month: str, threshold: int
+    ) -> list[tuple[User, int, int, int | None]]:
+        """Сотрудники, у которых осталось не больше threshold единиц; меньше остаток — выше."""
+        query = self._status_select(month)
+        used, limit = query.selected_columns.used, query.selected_columns.limit
+        result = await self._session.execute(
+            query.where(limit - used <= threshold).order_by(limit - used, User.full_name)
+        )
+        return [tuple(row) for row in result.all()]
+
     async def set_role_limit(self, role: str, limit: int) -> None:
         existing = await self.get_by_role(role)
         if existing:
@@ -42,6 +119,7 @@ class QuotaRepo:
             )
         else:
             self._session.add(Quota(role=role, monthly_limit=limit))
+        on_commit(self._session, lambda: quota_resolver.set_role(role, limit))
 
     async def set_personal_limit(self, user_id: int, limit: int) -> None:
         existing = await self.get_personal(user_id)
@@ -53,12 +131,39 @@ class QuotaRepo:
             )
         else:
             self._session.add(Quota(user_id=user_id, monthly_limit=limit))
+        on_commit(self._session, lambda: quota_resolver.set_personal(user_id, limit))
 
     async def remove_personal_limit(self, user_id: int) -> bool:
         quota = await self.get_personal(user_id)
         if not quota:
             return False
         await self._session.delete(quota)
+        on_commit(self._session, lambda: quota_resolver.remove_personal(user_id))
+        return True
+
+    async def _all_rows(self) -> list[tuple[str | None, int | None, int]]:
+        result = await self._session.execute(
+            select(Quota.role, Quota.user_id, Quota.monthly_limit).order_by(Quota.id)
+        )
+        return [tuple(row) for row in result.all()]
+
+    async def load_cache(self) -> None:
+        """Загружает все лимиты в quota_resolver (при старте, после seed_defaults)."""
+        quota_resolver.load(await self._all_rows())
+
+    async def verify_cache(self) -> bool:
+        """
+        Сверяет кэш лимитов с таблицей quotas и перезагружает его,
+        если БД правили в обход бота. Возвращает True, если была перезагрузка.
+        """
+        version = quota_resolver.version
+        rows = await self._all_rows()
+        if quota_resolver.version != version:
+            return False  # пока читали, бот сам поменял лимит — строки уже устарели
+        if quota_resolver.matches(rows):
+            return False
+        quota_resolver.load(rows)
+        quota_resolver.reloads += 1
         return True
 
     async def seed_defaults(self) -> None:
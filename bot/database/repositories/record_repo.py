@@ -1,38 +1,175 @@
-from datetime import datetime, timezone
+from collections.abc import Iterable
+from datetime import datetime, timedelta, timezone
 
-from sqlalchemy import func, select, update
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import (
+    ColumnElement,
+    Select,
+    case,
+    delete,
+    false,
+    func,
+    insert,
+    literal,
+    select,
+    true,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncResult, AsyncSession
+from sqlalchemy.orm import InstrumentedAttribute, aliased
 
-from bot.database.models import Record
+from bot.database.models import MonthlyRollup, MonthVersion, Record, User
+
+# is_cancelled сравнивается через "== false()" ("= 0"), а не ".is_(False)" ("IS 0"):
+# иначе SQLite не сопоставит условие с WHERE частичных индексов и пойдёт полным сканом.
+
+# Размер порции при потоковом чтении записей для отчётов
+_STREAM_CHUNK = 1000
+
+
+# Курсор постраничного чтения: (created_at или cancelled_at, id) граничной записи.
+# cancelled_at бывает NULL у возвратов из старых БД
+Cursor = tuple[datetime | None, int]
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(at: datetime | None, record_id: int) -> str:
+    """Курсор для callback_data: "<микросекунды от эпохи>:<id>" — точно и коротко; NULL — пусто."""
+    if at is None:
+        return f":{record_id}"
+    return f"{(at.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)}:{record_id}"
+
+
+def decode_cursor(value: str) -> Cursor:
+    """Обратное к encode_cursor. ValueError если строка испорчена."""
+    micros, record_id = value.split(":")
+    at = _EPOCH + timedelta(microseconds=int(micros)) if micros else None
+    return at, int(record_id)
 
 
 def _current_month() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m")
 
 
+def next_change_seq() -> ColumnElement[int]:
+    """
+    Номер следующего изменения records: max(changed_seq) + 1 (по индексу — один поиск).
+    Вычисляется внутри INSERT/UPDATE, то есть уже под блокировкой записи SQLite, которую
+    транзакция держит до commit: изменения, зафиксированные позже, всегда получают номер
+    больше. Время (created_at, cancelled_at) так не упорядочено — его ставит Python
+    до ожидания блокировки, и по нему дельта-выгрузка теряла бы записи.
+    """
+    latest = aliased(Record)
+    return select(func.coalesce(func.max(latest.changed_seq), 0) + 1).scalar_subquery()
+
+
 class RecordRepo:
     def __init__(self, session: AsyncSession) -> None:
         self._session = session
 
     async def count_used(self, user_id: int, month: str | None = None) -> int:
+        """Читает итог из monthly_rollups — один поиск по первичному ключу."""
         month = month or _current_month()
         result = await self._session.execute(
-            select(func.count(Record.id)).where(
-                Record.user_id == user_id,
-                Record.month == month,
-                Record.is_cancelled.is_(False),
+            select(MonthlyRollup.active).where(
+                MonthlyRollup.month == month,
+                MonthlyRollup.user_id == user_id,
             )
         )
-        return result.scalar_one()
+        return result.scalar_one_or_none() or 0
+
+    async def _bump_rollup(self, user_id: int, month: str, active: int, returned: int = 0) -> None:
+        """Изменяет итоги сотрудника за месяц на active/returned в текущей транзакции (upsert)."""
+        await self._session.execute(
+            sqlite_insert(MonthlyRollup)
+            .values(month=month, user_id=user_id, active=max(active, 0), returned=max(returned, 0))
+            .on_conflict_do_update(
+                index_elements=[MonthlyRollup.month, MonthlyRollup.user_id],
+                set_={
+                    "active": MonthlyRollup.active + active,
+                    "returned": MonthlyRollup.returned + returned,
+                },
+            )
+        )
+
+    async def bump_month_versions(self, months: Iterable[str]) -> None:
+        """Помечает данные месяцев изменёнными — кэшированные отчёты по ним устаревают."""
+        for month in set(months):
+            await self._session.execute(
+                sqlite_insert(MonthVersion)
+                .values(month=month, version=1)
+                .on_conflict_do_update(
+                    index_elements=[MonthVersion.month],
+                    set_={"version": MonthVersion.version + 1},
+                )
+            )
+
+    async def get_month_versions(self, months: list[str]) -> dict[str, int]:
+        """Версии данных месяцев; для месяцев без изменений — 0."""
+        result = await self._session.execute(
+            select(MonthVersion.month, MonthVersion.version).where(MonthVersion.month.in_(months))
+        )
+        versions = dict(result.tuples().all())
+        return {month: versions.get(month, 0) for month in months}
+
+    async def get_user_months(self, user_id: int) -> list[str]:
+        result = await self._session.execute(
+            select(Record.month).where(Record.user_id == user_id).distinct()
+        )
+        return list(result.scalars().all())
 
     async def create(self, user_id: int, site_number: str) -> Record:
         record = Record(
             user_id=user_id,
             site_number=site_number,
             month=_current_month(),
+            changed_seq=next_change_seq(),
         )
         self._session.add(record)
         await self._session.flush()
+        await self._bump_rollup(user_id, record.month, 1)
+        await self.bump_month_versions([record.month])
+        return record
+
+    async def create_within_limit(
+        self, user_id: int, site_number: str, limit: ColumnElement[int] | int
+    ) -> Record | None:
+        """
+        Создаёт запись, только если за текущий месяц использовано меньше limit.
+        Проверка и вставка — одно выражение INSERT ... SELECT ... WHERE used < limit,
+        SQLite выполняет его атомарно под блокировкой записи; итоги месяца
+        обновляются следующим выражением той же транзакции.
+        Возвращает созданную запись или None если квота исчерпана.
+        """
+        month = _current_month()
+        used = func.coalesce(
+            select(MonthlyRollup.active)
+            .where(MonthlyRollup.month == month, MonthlyRollup.user_id == user_id)
+            .scalar_subquery(),
+            0,
+        )
+        source = select(
+            literal(user_id, Record.user_id.type),
+            literal(site_number, Record.site_number.type),
+            literal(datetime.now(timezone.utc), Record.created_at.type),
+            literal(month, Record.month.type),
+            literal(False, Record.is_cancelled.type),
+            next_change_seq(),
+        ).where(used < limit)
+        result = await self._session.execute(
+            insert(Record)
+            .from_select(
+                ["user_id", "site_number", "created_at", "month", "is_cancelled", "changed_seq"],
+                source,
+            )
+            .returning(Record)
+        )
+        record = result.scalar_one_or_none()
+        if record is not None:
+            await self._bump_rollup(user_id, month, 1)
+            await self.bump_month_versions([month])
         return record
 
     async def find_active(
@@ -46,7 +183,7 @@ class RecordRepo:
                 Record.user_id == user_id,
                 Record.site_number == site_number,
                 Record.month == month,
-                Record.is_cancelled.is_(False),
+                Record.is_cancelled == false(),
             )
             .order_by(Record.created_at.desc())
             .limit(1)
@@ -54,90 +191,249 @@ class RecordRepo:
         return result.scalar_one_or_none()
 
     async def cancel(self, record_id: int) -> None:
-        await self._session.execute(
+        result = await self._session.execute(
             update(Record)
-            .where(Record.id == record_id)
-            .values(is_cancelled=True, cancelled_at=datetime.now(timezone.utc))
+            .where(Record.id == record_id, Record.is_cancelled == false())
+            .values(
+                is_cancelled=True,
+                cancelled_at=datetime.now(timezone.utc),
+                changed_seq=next_change_seq(),
+            )
+            .returning(Record.user_id, Record.month)
         )
+        row = result.one_or_none()
+        if row is not None:
+            await self._bump_rollup(row.user_id, row.month, -1, returned=1)
+            await self.bump_month_versions([row.month])
+
+    async def rebuild_rollups(self) -> int:
+        """
+        Пересобирает monthly_rollups из records.
+        Возвращает количество пар (месяц, сотрудник), где итоги расходились.
+        """
+        result = await self._session.execute(
+            select(
+                Record.month,
+                Record.user_id,
+                func.sum(case((Record.is_cancelled == false(), 1), else_=0)),
+                func.sum(case((Record.is_cancelled == true(), 1), else_=0)),
+            )
+            .group_by(Record.month, Record.user_id)
+        )
+        actual = {(month, user_id): (active, returned) for month, user_id, active, returned in result.all()}
+        result = await self._session.execute(
+            select(MonthlyRollup.month, MonthlyRollup.user_id, MonthlyRollup.active, MonthlyRollup.returned)
+            .where((MonthlyRollup.active != 0) | (MonthlyRollup.returned != 0))
+        )
+        stored = {(month, user_id): (active, returned) for month, user_id, active, returned in result.all()}
+        mismatched = sum(
+            1 for key in actual.keys() | stored.keys() if actual.get(key) != stored.get(key)
+        )
+
+        await self._session.execute(delete(MonthlyRollup))
+        if actual:
+            await self._session.execute(
+                insert(MonthlyRollup),
+                [
+                    {"month": month, "user_id": user_id, "active": active, "returned": returned}
+                    for (month, user_id), (active, returned) in actual.items()
+                ],
+            )
+        return mismatched
+
+    async def _seek(
+        self,
+        query: Select,
+        key: InstrumentedAttribute,
+        limit: int,
+        after: Cursor | None,
+        before: Cursor | None,
+    ) -> tuple[list[Record], bool]:
+        """
+        Страница по ключу (key, id), новые первые, без OFFSET: позиция задаётся курсором,
+        и SQLite начинает чтение индекса сразу с неё, как бы далеко ни была страница.
+        after — записи старше курсора (→), before — новее курсора (←).
+        Возвращает (до limit записей, есть ли ещё записи в направлении листания).
+
+        Записи с key = NULL (возвраты, сделанные до появления cancelled_at) считаются
+        самыми старыми и читаются отдельным запросом после остальных: условие
+        "... OR key IS NULL" лишило бы SQLite диапазона по индексу.
+        """
+        nullable = key.property.columns[0].nullable
+        position = tuple_(key, Record.id)
+        parts: list[Select] = []
+        if before is None:
+            at, record_id = after if after is not None else (None, None)
+            if after is None:
+                parts.append(query.where(key.is_not(None)) if nullable else query)
+            elif at is not None:
+                parts.append(query.where(position < tuple_(*after)))
+            parts = [part.order_by(key.desc(), Record.id.desc()) for part in parts]
+            if nullable:
+                older = query.where(key.is_(None))
+                if after is not None and at is None:
+                    older = older.where(Record.id < record_id)
+                parts.append(older.order_by(Record.id.desc()))
+        else:
+            at, record_id = before
+            if at is None:
+                parts.append(query.where(key.is_(None), Record.id > record_id).order_by(Record.id))
+                parts.append(query.where(key.is_not(None)).order_by(key, Record.id))
+            else:
+                parts.append(query.where(position > tuple_(*before)).order_by(key, Record.id))
+
+        records: list[Record] = []
+        for part in parts:
+            if len(records) > limit:
+                break
+            result = await self._session.execute(part.limit(limit + 1 - len(records)))
+            records.extend(result.scalars().all())
+        has_more = len(records) > limit
+        records = records[:limit]
+        if before is not None:
+            records.reverse()
+        return records, has_more
 
     async def get_cancelled_records(
-        self, months: list[str] | None = None, offset: int = 0, limit: int = 20
-    ) -> list[Record]:
-        """Все отменённые записи (возвраты), новые первые."""
-        query = select(Record).where(Record.is_cancelled.is_(True))
+        self,
+        months: list[str] | None = None,
+        limit: int = 20,
+        after: Cursor | None = None,
+        before: Cursor | None = None,
+    ) -> tuple[list[Record], bool]:
+        """Отменённые записи (возвраты), новые первые, постранично по курсору (cancelled_at, id)."""
+        query = select(Record).where(Record.is_cancelled == true())
         if months:
             query = query.where(Record.month.in_(months))
-        query = query.order_by(Record.cancelled_at.desc()).offset(offset).limit(limit)
-        result = await self._session.execute(query)
-        return list(result.scalars().all())
+        return await self._seek(query, Record.cancelled_at, limit, after, before)
 
     async def count_cancelled_records(self, months: list[str] | None = None) -> int:
-        """Количество отменённых записей за период."""
-        query = select(func.count(Record.id)).where(Record.is_cancelled.is_(True))
+        """Количество отменённых записей за период — сумма по monthly_rollups, без COUNT по records."""
+        query = select(func.coalesce(func.sum(MonthlyRollup.returned), 0))
         if months:
-            query = query.where(Record.month.in_(months))
+            query = query.where(MonthlyRollup.month.in_(months))
         result = await self._session.execute(query)
         return result.scalar_one()
 
     async def get_history(
-        self, user_id: int, offset: int = 0, limit: int = 30
-    ) -> list[Record]:
-        """Активные записи пользователя, новые первые."""
+        self,
+        user_id: int,
+        limit: int = 30,
+        after: Cursor | None = None,
+        before: Cursor | None = None,
+    ) -> tuple[list[Record], bool]:
+        """Активные записи пользователя, новые первые, постранично по курсору (created_at, id)."""
+        query = select(Record).where(
+            Record.user_id == user_id,
+            Record.is_cancelled == false(),
+        )
+        return await self._seek(query, Record.created_at, limit, after, before)
+
+    async def get_usage_with_history(
+        self, user_id: int, limit: int = 0
+    ) -> tuple[int, int, list[Record]]:
+        """
+        Одним запросом: (использовано за текущий месяц, всего активных записей,
+        первые limit записей истории). Оба счётчика берутся из monthly_rollups
+        скалярными подзапросами к каждой строке страницы истории.
+        """
+        month = _current_month()
+        used = (
+            select(MonthlyRollup.active)
+            .where(MonthlyRollup.month == month, MonthlyRollup.user_id == user_id)
+            .scalar_subquery()
+        )
+        total = (
+            select(func.coalesce(func.sum(MonthlyRollup.active), 0))
+            .where(MonthlyRollup.user_id == user_id)
+            .scalar_subquery()
+        )
+        if limit <= 0:
+            result = await self._session.execute(select(used, total))
+            used_value, total_value = result.one()
+            return used_value or 0, total_value, []
+
         result = await self._session.execute(
-            select(Record)
+            select(Record, used, total)
             .where(
                 Record.user_id == user_id,
-                Record.is_cancelled.is_(False),
+                Record.is_cancelled == false(),
             )
-            .order_by(Record.created_at.desc())
-            .offset(offset)
+            .order_by(Record.created_at.desc(), Record.id.desc())
             .limit(limit)
         )
-        return list(result.scalars().all())
+        rows = result.all()
+        if not rows:
+            # Нет ни одной активной записи — значит и счётчики нулевые
+            return 0, 0, []
+        return rows[0][1] or 0, rows[0][2], [row[0] for row in rows]
 
     async def count_history(self, user_id: int) -> int:
+        """Всего активных записей пользователя — сумма по monthly_rollups."""
         result = await self._session.execute(
-            select(func.count(Record.id)).where(
-                Record.user_id == user_id,
-                Record.is_cancelled.is_(False),
-            )
+            select(func.coalesce(func.sum(MonthlyRollup.active), 0))
+            .where(MonthlyRollup.user_id == user_id)
         )
         return result.scalar_one()
 
-    async def get_by_month_all_users(self, month: str) -> list[Record]:
-        """Все активные записи за месяц (для отчёта)."""
-        result = await self._session.execute(
-            select(Record)
-            .where(Record.month == month, Record.is_cancelled.is_(False))
-            .order_by(Record.created_at)
+    async def stream_report_rows(self, months: list[str]) -> AsyncResult:
+        """
+        Все записи за список месяцев включая возвраты (для полного отчёта) — одним
+        запросом, по порядку (месяц, дата выдачи), с ФИО и ролью сотрудника.
+        Читается курсором порциями по _STREAM_CHUNK строк; выбираются только колонки,
+        без ORM-объектов, чтобы не наполнять identity map сессии.
+        """
+        return await self._session.stream(
+            select(
+                Record.id,
+                Record.month,
+                Record.user_id,
+                Record.site_number,
+                Record.created_at,
+                Record.cancelled_at,
+                Record.is_cancelled,
+                Record.changed_seq,
+                User.full_name,
+                User.role,
+            )
+            .outerjoin(User, User.telegram_id == Record.user_id)
+            .where(Record.month.in_(months))
+            .order_by(Record.month, Record.created_at)
+            .execution_options(yield_per=_STREAM_CHUNK)
         )
-        return list(result.scalars().all())
 
-    async def get_by_month_all_users_full(self, month: str) -> list[Record]:
-        """Все записи за месяц включая возвраты (для полного отчёта)."""
-        result = await self._session.execute(
-            select(Record)
-            .where(Record.month == month)
-            .order_by(Record.created_at)
+    async def stream_changed_rows(self, after_seq: int) -> AsyncResult:
+        """
+        Записи, выданные или возвращённые после изменения номер after_seq (для
+        дельта-выгрузки), по порядку changed_seq, с теми же колонками, что stream_report_rows.
+        after_seq=0 — выгрузка с начала, то есть все записи.
+        """
+        return await self._session.stream(
+            select(
+                Record.id,
+                Record.month,
+                Record.user_id,
+                Record.site_number,
+                Record.created_at,
+                Record.cancelled_at,
+                Record.is_cancelled,
+                Record.changed_seq,
+                User.full_name,
+                User.role,
+            )
+            .outerjoin(User, User.telegram_id == Record.user_id)
+            .where(Record.changed_seq > after_seq)
+            .order_by(Record.changed_seq)
+            .execution_options(yield_per=_STREAM_CHUNK)
         )
-        return list(result.scalars().all())
 
     async def get_stats_months(self) -> list[str]:
-        """Список месяцев, в которых есть активные записи."""
+        """Список месяцев, в которых есть активные записи, — по monthly_rollups, без обхода records."""
         result = await self._session.execute(
-            select(Record.month)
-            .where(Record.is_cancelled.is_(False))
+            select(MonthlyRollup.month)
+            .where(MonthlyRollup.active > 0)
             .distinct()
-            .order_by(Record.month.desc())
-        )
-        return list(result.scalars().all())
-
-    async def get_by_months(self, months: list[str]) -> list[Record]:
-        """Все активные записи за список месяцев (для сводной статистики)."""
-        result = await self._session.execute(
-            select(Record)
-            .where(Record.month.in_(months), Record.is_cancelled.is_(False))
-            .order_by(Record.month.desc(), Record.created_at)
+            .order_by(MonthlyRollup.month.desc())
         )
         return list(result.scalars().all())
 
@@ -151,7 +447,7 @@ class RecordRepo:
             .where(
                 Record.site_number == site_number,
                 Record.month == month,
-                Record.is_cancelled.is_(False),
+                Record.is_cancelled == false(),
             )
             .order_by(Record.created_at.desc())
             .limit(1)
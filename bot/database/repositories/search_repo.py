@@ -0,0 +1,164 @@
+import re
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import Select, column, func, literal_column, select, table
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.database.models import Record, User
+
+# Разбиение на слова как у токенайзера unicode61: всё, кроме букв и цифр, — разделитель
+_TOKEN_RE = re.compile(r"[^\W_]+")
+_PHONE_QUERY_RE = re.compile(r"^\+?[\d\s\-\(\)]+$")
+_PHONE_MIN_DIGITS = 4
+# Однобуквенный префикс раскрывается в тысячи токенов — одиночный такой токен ищем
+# целиком. Во фразе («12/4») префикс остаётся: её сужает предыдущий токен
+_PREFIX_MIN_LEN = 2
+# Договоры ранжируются среди стольких самых новых совпадений: запрос вроде «12»
+# совпадает с половиной таблицы, и bm25 по всем строкам занял бы сотни мс
+_RECORDS_RANK_WINDOW = 500
+
+# FTS5-таблицы создаются в init_db сырым DDL — в ORM только то, что нужно для запросов
+_users_fts = table("users_fts", column("rowid"))
+_records_fts = table("records_fts", column("rowid"), column("rank"))
+
+
+@dataclass
+class UserHit:
+    telegram_id: int
+    full_name: str
+    phone: str
+    role: str
+
+
+@dataclass
+class RecordHit:
+    id: int
+    site_number: str
+    month: str
+    created_at: datetime
+    is_cancelled: bool
+    user_id: int
+    full_name: str | None
+
+
+def _phrase(term: str, prefix_min_len: int) -> str | None:
+    """Одно слово запроса → фраза FTS5 с поиском по началу последнего токена: 12/34 → "12 34"*."""
+    tokens = _TOKEN_RE.findall(term.replace("ё", "е").replace("Ё", "Е"))
+    if not tokens:
+        return None
+    phrase = '"' + " ".join(tokens) + '"'
+    if len(tokens) == 1 and len(tokens[0]) < prefix_min_len:
+        return phrase
+    return phrase + "*"
+
+
+def fts_query(search: str, prefix_min_len: int = _PREFIX_MIN_LEN) -> str | None:
+    """Запрос админа → выражение MATCH: все слова должны встретиться (по началу). None — искать нечего."""
+    phrases = [p for p in (_phrase(term, prefix_min_len) for term in search.split()) if p]
+    return " ".join(phrases) or None
+
+
+def user_ids_by_name(search: str) -> Select | None:
+    """
+    telegram_id сотрудников, в ФИО которых есть слова, начинающиеся со слов search
+    («петр ив» → «Иванов Пётр»). Сотрудников немного — ищем и по одной букве.
+    None — в запросе нет ни буквы, ни цифры.
+    """
+    match = fts_query(search, prefix_min_len=1)
+    if match is None:
+        return None
+    return select(_users_fts.c.rowid).where(
+        literal_column("users_fts").op("MATCH")(f"full_name : ({match})")
+    )
+
+
+def phone_query(search: str) -> str | None:
+    """Похоже на телефон — ищем по цифрам целиком; 8/7 в начале 11-значного номера отбрасываем."""
+    if not _PHONE_QUERY_RE.match(search.strip()):
+        return None
+    digits = re.sub(r"\D", "", search)
+    if len(digits) < _PHONE_MIN_DIGITS:
+        return None
+    if len(digits) == 11 and digits[0] in "78":
+        digits = digits[1:]
+    return f'phone : "{digits}"*'
+
+
+def _record_hits() -> Select:
+    """Колонки RecordHit: запись и ФИО сотрудника (если он ещё есть)."""
+    return select(
+        Record.id,
+        Record.site_number,
+        Record.month,
+        Record.created_at,
+        Record.is_cancelled,
+        Record.user_id,
+        User.full_name,
+    ).outerjoin(User, User.telegram_id == Record.user_id)
+
+
+class SearchRepo:
+    """
+    Поиск админа по FTS5-таблицам users_fts (ФИО, телефон) и records_fts (№ договора)
+    за все месяцы. Порядок — bm25; таблицы ведут триггеры,
+    см. base._FTS_TABLES и base._FTS_TRIGGERS.
+    """
+
+    def __init__(self, session: AsyncSession) -> None:
+        self._session = session
+
+    async def users(self, search: str, limit: int) -> list[UserHit]:
+        match = fts_query(search)
+        phone = phone_query(search)
+        if phone:
+            match = f"({match}) OR {phone}" if match else phone
+        if not match:
+            return []
+        result = await self._session.execute(
+            select(User.telegram_id, User.full_name, User.phone, User.role)
+            .join(_users_fts, _users_fts.c.rowid == User.telegram_id)
+            .where(literal_column("users_fts").op("MATCH")(match))
+            # ФИО весит больше телефона: «Иванов» в имени важнее совпадения цифр
+            .order_by(func.bm25(literal_column("users_fts"), 2.0, 1.0), User.full_name)
+            .limit(limit)
+        )
+        return [UserHit(*row) for row in result.all()]
+
+    async def records(self, search: str, limit: int) -> list[RecordHit]:
+        """
+        Договоры по номеру: сначала точные совпадения (по индексу, за все месяцы),
+        дальше по bm25 и от новых к старым среди _RECORDS_RANK_WINDOW самых новых совпадений.
+        """
+        site_number = search.strip()
+        hits: list[RecordHit] = []
+        if site_number:
+            result = await self._session.execute(
+                _record_hits()
+                .where(Record.site_number == site_number)
+                .order_by(Record.id.desc())
+                .limit(limit)
+            )
+            hits = [RecordHit(*row) for row in result.all()]
+        match = fts_query(search)
+        if not match or len(hits) >= limit:
+            return hits
+
+        # Окно ограничивает только ранжирование: «100» по началу совпадает с 1000…, 10000…,
+        # и точный «100» старше окна в него бы не попал — поэтому он найден отдельно выше
+        candidates = (
+            select(_records_fts.c.rowid, _records_fts.c.rank)
+            .where(literal_column("records_fts").op("MATCH")(match))
+            .order_by(_records_fts.c.rowid.desc())
+            .limit(_RECORDS_RANK_WINDOW)
+            .subquery()
+        )
+        result = await self._session.execute(
+            _record_hits()
+            .join(candidates, candidates.c.rowid == Record.id)
+            .where(Record.site_number != site_number)
+            .order_by(candidates.c.rank, Record.id.desc())
+            .limit(limit - len(hits))
+        )
+        return hits + [RecordHit(*row) for row in result.all()]
+
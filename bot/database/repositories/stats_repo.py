@@ -0,0 +1,121 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy import false, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.database.models import MonthlyRollup, Record, User
+
+
+@dataclass
+class UserStats:
+    """Итоги сотрудника за период: выдачи (всего и по месяцам) и возвраты."""
+
+    user_id: int
+    full_name: str | None
+    role: str | None
+    total: int
+    returned: int
+    by_month: dict[str, int] = field(default_factory=dict)  # выдано (активных) по месяцам
+
+
+class StatsRepo:
+    """
+    Статистика для админа. Итоги читаются из monthly_rollups — по строке на пару
+    (месяц, сотрудник) и только для одной страницы сотрудников; договоры из records
+    загружаются отдельно, для одного сотрудника и тоже постранично.
+    """
+
+    def __init__(self, session: AsyncSession) -> None:
+        self._session = session
+
+    async def period_totals(self, months: list[str]) -> tuple[int, int]:
+        """(выдано, возвращено) за месяцы — сумма по monthly_rollups."""
+        result = await self._session.execute(
+            select(
+                func.coalesce(func.sum(MonthlyRollup.active), 0),
+                func.coalesce(func.sum(MonthlyRollup.returned), 0),
+            )
+            .where(MonthlyRollup.month.in_(months))
+        )
+        active, returned = result.one()
+        return active, returned
+
+    async def count_users(self, months: list[str]) -> int:
+        """Сколько сотрудников выдавали что-то за месяцы."""
+        result = await self._session.execute(
+            select(func.count(func.distinct(MonthlyRollup.user_id)))
+            .where(MonthlyRollup.month.in_(months), MonthlyRollup.active > 0)
+        )
+        return result.scalar_one()
+
+    async def users_page(self, months: list[str], offset: int, limit: int) -> list[UserStats]:
+        """
+        Страница сотрудников с выдачами за месяцы, больше всего выдач — первыми.
+        Сотрудники, у которых за период только возвраты, в список не попадают.
+        """
+        total = func.sum(MonthlyRollup.active)
+        result = await self._session.execute(
+            select(
+                MonthlyRollup.user_id,
+                User.full_name,
+                User.role,
+                total,
+                func.sum(MonthlyRollup.returned),
+            )
+            .outerjoin(User, User.telegram_id == MonthlyRollup.user_id)
+            .where(MonthlyRollup.month.in_(months))
+            .group_by(MonthlyRollup.user_id)
+            .having(total > 0)
+            .order_by(total.desc(), MonthlyRollup.user_id)
+            .offset(offset)
+            .limit(limit)
+        )
+        page = [UserStats(*row) for row in result.tuples().all()]
+        if len(months) > 1 and page:
+            by_user = {s.user_id: s for s in page}
+            result = await self._session.execute(
+                select(MonthlyRollup.user_id, MonthlyRollup.month, MonthlyRollup.active)
+                .where(
+                    MonthlyRollup.month.in_(months),
+                    MonthlyRollup.user_id.in_(by_user),
+                    MonthlyRollup.active > 0,
+                )
+            )
+            for user_id, month, active in result.tuples().all():
+                by_user[user_id].by_month[month] = active
+        return page
+
+    async def user_stats(self, user_id: int, months: list[str]) -> UserStats | None:
+        """Итоги одного сотрудника за месяцы; None если такого сотрудника нет."""
+        user = await self._session.get(User, user_id)
+        if user is None:
+            return None
+        result = await self._session.execute(
+            select(MonthlyRollup.month, MonthlyRollup.active, MonthlyRollup.returned)
+            .where(MonthlyRollup.month.in_(months), MonthlyRollup.user_id == user_id)
+        )
+        stats = UserStats(user_id, user.full_name, user.role, 0, 0)
+        for month, active, returned in result.tuples().all():
+            stats.total += active
+            stats.returned += returned
+            if active:
+                stats.by_month[month] = active
+        return stats
+
+    async def user_contracts(
+        self, user_id: int, months: list[str], offset: int, limit: int
+    ) -> list[tuple[str, datetime]]:
+        """Активные договоры сотрудника за месяцы по дате выдачи: [(№ договора, дата выдачи)]."""
+        result = await self._session.execute(
+            select(Record.site_number, Record.created_at)
+            .where(
+                Record.user_id == user_id,
+                Record.month.in_(months),
+                Record.is_cancelled == false(),
+            )
+            .order_by(Record.created_at, Record.id)
+            .offset(offset)
+            .limit(limit)
+        )
+        return list(result.tuples().all())
@@ -1,7 +1,11 @@
-from sqlalchemy import select, update
+from sqlalchemy import func, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from bot.database.models import User
+from bot.database.base import on_commit
+from bot.database.cache import MISSING, UserSnapshot, quota_resolver, user_cache, user_count_cache
+from bot.database.models import User, name_search_key
+from bot.database.repositories.record_repo import RecordRepo
+from bot.database.repositories.search_repo import user_ids_by_name
 
 
 class UserRepo:
@@ -14,6 +18,16 @@ class UserRepo:
         )
         return result.scalar_one_or_none()
 
+    async def get_snapshot(self, telegram_id: int) -> UserSnapshot | None:
+        """Пользователь из кэша процесса; в БД идём только при промахе."""
+        snapshot = user_cache.get(telegram_id)
+        if snapshot is MISSING:
+            version = user_cache.version
+            user = await self.get_by_telegram_id(telegram_id)
+            snapshot = UserSnapshot.from_user(user) if user else None
+            user_cache.set(telegram_id, snapshot, version)
+        return snapshot
+
     async def create(
         self,
         telegram_id: int,
@@ -25,12 +39,14 @@ class UserRepo:
         user = User(
             telegram_id=telegram_id,
             full_name=full_name,
+            search_name=name_search_key(full_name),
             phone=phone,
             role=role,
             is_admin=is_admin,
         )
         self._session.add(user)
         await self._session.flush()
+        on_commit(self._session, lambda: self._forget(telegram_id))
         return user
 
     async def set_admin(self, telegram_id: int, is_admin: bool) -> None:
@@ -39,6 +55,16 @@ class UserRepo:
             .where(User.telegram_id == telegram_id)
             .values(is_admin=is_admin)
         )
+        on_commit(self._session, lambda: user_cache.invalidate(telegram_id))
+
+    async def get_many(self, telegram_ids: list[int]) -> list[User]:
+        """Пользователи по списку id (например, авторы записей одной страницы) — один запрос по PK."""
+        if not telegram_ids:
+            return []
+        result = await self._session.execute(
+            select(User).where(User.telegram_id.in_(set(telegram_ids)))
+        )
+        return list(result.scalars().all())
 
     async def get_all(self) -> list[User]:
         result = await self._session.execute(
@@ -46,10 +72,53 @@ class UserRepo:
         )
         return list(result.scalars().all())
 
+    @staticmethod
+    def _filter(query, search: str | None):
+        """Поиск по любому слову ФИО (по началу слова) — через FTS-таблицу users_fts."""
+        ids = user_ids_by_name(search or "")
+        if ids is None:
+            return query
+        return query.where(User.telegram_id.in_(ids))
+
+    async def page(self, offset: int, limit: int, search: str | None = None) -> list[User]:
+        """Страница сотрудников по алфавиту; search — слова ФИО (можно начало) без учёта регистра и ё."""
+        result = await self._session.execute(
+            self._filter(select(User), search)
+            .order_by(User.search_name, User.telegram_id)
+            .offset(offset)
+            .limit(limit)
+        )
+        return list(result.scalars().all())
+
+    async def count(self, search: str | None = None) -> int:
+        """Сколько сотрудников (подходит под search). Общее число берётся из кэша."""
+        if user_ids_by_name(search or "") is None:
+            total = user_count_cache.get(None)
+            if total is MISSING:
+                version = user_count_cache.version
+                total = await self._session.scalar(select(func.count()).select_from(User))
+                user_count_cache.set(None, total, version)
+            return total
+        return await self._session.scalar(
+            self._filter(select(func.count()).select_from(User), search)
+        )
+
     async def delete(self, telegram_id: int) -> bool:
         user = await self.get_by_telegram_id(telegram_id)
         if not user:
             return False
+        # Записи удаляются каскадом — отчёты за их месяцы больше не актуальны
+        record_repo = RecordRepo(self._session)
+        await record_repo.bump_month_versions(await record_repo.get_user_months(telegram_id))
         await self._session.delete(user)
         await self._session.flush()  # явно отправляем DELETE до коммита
+        on_commit(self._session, lambda: self._forget(telegram_id, personal_quota=True))
         return True
+
+    @staticmethod
+    def _forget(telegram_id: int, personal_quota: bool = False) -> None:
+        """Сброс кэшей после commit регистрации/удаления."""
+        user_cache.invalidate(telegram_id)
+        user_count_cache.clear()
+        if personal_quota:
+            quota_resolver.remove_personal(telegram_id)  # персональная квота удалена каскадом
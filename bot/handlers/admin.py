@@ -1,34 +1,51 @@
 import asyncio
 import logging
 import re
-from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timezone
+from html import escape
 
 from aiogram import Bot, F, Router
 from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
-from aiogram.filters import Filter
+from aiogram.filters import Command, Filter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import BufferedInputFile, CallbackQuery, Message
+from aiogram.types import CallbackQuery, InlineKeyboardButton, Message
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from bot.database.cache import quota_resolver, user_cache
 from bot.database.models import ROLE_LABELS, ROLES, User
 from bot.database.repositories.quota_repo import QuotaRepo
-from bot.database.repositories.record_repo import RecordRepo
+from bot.database.repositories.record_repo import Cursor, RecordRepo, decode_cursor, encode_cursor
+from bot.database.repositories.search_repo import SearchRepo, user_ids_by_name
+from bot.database.repositories.stats_repo import StatsRepo
 from bot.database.repositories.user_repo import UserRepo
 from bot.keyboards.admin import (
     admin_menu_kb,
     broadcast_target_kb,
+    cancel_kb,
     confirm_kb,
+    export_format_kb,
+    export_job_kb,
     months_kb,
     quota_target_kb,
+    stats_page_kb,
     stats_period_kb,
+    stats_user_kb,
     users_list_kb,
 )
 from bot.config import fmt_dt
 from bot.keyboards.employee import main_menu_kb
-from bot.services.export_service import build_excel
+from bot.services.export_jobs import ExportQueueFull, export_jobs
+from bot.services.export_service import EXPORT_KINDS
 from bot.services.quota_service import QuotaService
-from bot.states.admin import AdminDeleteUserStates, AdminQuotaStates, AdminReturnStates, BroadcastStates
+from bot.services.report_cache import report_cache, report_file_ids
+from bot.states.admin import (
+    AdminDeleteUserStates,
+    AdminQuotaStates,
+    AdminReturnStates,
+    AdminSearchStates,
+    BroadcastStates,
+    UserSearchStates,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +53,15 @@ router = Router(name="admin")
 
 _SITE_RE = re.compile(r"^[\w\-/\.]{1,100}$")
 _USERS_PAGE_SIZE = 8
+_USER_SEARCH_MAX_LEN = 100
+_NEAR_LIMIT_THRESHOLD = 1  # «близко к лимиту» — осталось не больше стольких единиц
+_NEAR_LIMIT_MAX_LINES = 50
+_STATS_PAGE_SIZE = 10  # сотрудников на странице статистики
+_STATS_CONTRACTS_PAGE_SIZE = 25  # договоров на странице сотрудника: № договора до 100 символов
+_STATS_MONTH_BREAKDOWN_MAX = 6
+_SEARCH_MAX_LEN = 100
+_SEARCH_USERS_LIMIT = 8  # и столько же кнопок с карточками
+_SEARCH_RECORDS_LIMIT = 10  # № договора и ФИО до 100 символов — держимся в 4096 символах
 
 
 class IsAdmin(Filter):
@@ -66,38 +92,86 @@ async def admin_back(message: Message, is_admin: bool, state: FSMContext) -> Non
 # Список сотрудников
 # ---------------------------------------------------------------------------
 
-@router.message(F.text == "👥 Сотрудники")
-async def employees_list(message: Message, session: AsyncSession) -> None:
+# Списки выбора сотрудника: action → состояние, в котором список открыт (None — без FSM)
+_USER_PICKERS = {
+    "emp": None,
+    "quser": AdminQuotaStates.choose_user,
+    "bcast": BroadcastStates.choose_user,
+}
+
+
+async def _users_picker(
+    session: AsyncSession, action: str, page: int, search: str | None = None
+):
+    """
+    Страница списка выбора сотрудника: (текст, клавиатура, сколько всего).
+    Из БД читаются только сотрудники страницы; search — слова ФИО из «🔎 Поиск по имени».
+    """
     repo = UserRepo(session)
-    users = await repo.get_all()
-    if not users:
-        await message.answer("Нет зарегистрированных сотрудников.")
-        return
+    total = await repo.count(search)
+    total_pages = max(1, (total + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
+    page = max(0, min(page, total_pages - 1))
+    page_users = await repo.page(page * _USERS_PAGE_SIZE, _USERS_PAGE_SIZE, search)
 
-    total_pages = max(1, (len(users) + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
-    page_users = users[:_USERS_PAGE_SIZE]
-    await message.answer(
-        f"Зарегистрировано сотрудников: <b>{len(users)}</b>",
-        parse_mode="HTML",
-        reply_markup=users_list_kb(page_users, 0, total_pages, "emp"),
+    if search:
+        text = (
+            f"Найдено по «{escape(search)}»: <b>{total}</b>"
+            if total
+            else f"По «{escape(search)}» никого не найдено."
+        )
+    elif action == "emp":
+        text = f"Зарегистрировано сотрудников: <b>{total}</b>"
+    else:
+        text = "Выберите сотрудника:"
+
+    extra_buttons = [
+        InlineKeyboardButton(text="🔎 Поиск по имени", callback_data=f"{action}:search")
+    ]
+    if search:
+        extra_buttons.append(
+            InlineKeyboardButton(text="✖️ Сбросить поиск", callback_data=f"{action}:nosearch")
+        )
+    statuses = None
+    if action != "bcast":
+        # «used/limit» у каждого имени — квоты страницы одним запросом
+        statuses = await QuotaService(session).get_status_many([u.telegram_id for u in page_users])
+    if action == "emp":
+        extra_buttons.append(InlineKeyboardButton(text="⚠️ Близки к лимиту", callback_data="emp:near"))
+    kb = users_list_kb(
+        page_users, page, total_pages, action, statuses=statuses, extra_buttons=extra_buttons
     )
+    return text, kb, total
+
+
+async def _picker_is_current(callback: CallbackQuery, state: FSMContext, action: str) -> bool:
+    """Кнопка списка из завершённого сценария (квота, рассылка) — отвечаем алертом."""
+    expected = _USER_PICKERS[action]
+    if expected is not None and await state.get_state() != expected.state:
+        await callback.answer("Список устарел, начните заново", show_alert=True)
+        return False
+    return True
+
+
+@router.message(F.text == "👥 Сотрудники")
+async def employees_list(message: Message, session: AsyncSession, state: FSMContext) -> None:
+    await state.update_data(user_search=None)
+    text, kb, total = await _users_picker(session, "emp", 0)
+    if not total:
+        await message.answer("Нет зарегистрированных сотрудников.")
+        return
+    await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
 
 @router.callback_query(F.data.startswith("emp:page:"))
-async def employees_page(callback: CallbackQuery, session: AsyncSession) -> None:
+async def employees_page(callback: CallbackQuery, session: AsyncSession, state: FSMContext) -> None:
     try:
         page = int(callback.data.split(":")[-1])
     except ValueError:
         await callback.answer("Некорректный запрос", show_alert=True)
         return
-    repo = UserRepo(session)
-    users = await repo.get_all()
-    total_pages = max(1, (len(users) + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
-    page = max(0, min(page, total_pages - 1))
-    page_users = users[page * _USERS_PAGE_SIZE: (page + 1) * _USERS_PAGE_SIZE]
-    await callback.message.edit_reply_markup(
-        reply_markup=users_list_kb(page_users, page, total_pages, "emp")
-    )
+    data = await state.get_data()
+    _, kb, _ = await _users_picker(session, "emp", page, data.get("user_search"))
+    await callback.message.edit_reply_markup(reply_markup=kb)
     await callback.answer()
 
 
@@ -111,22 +185,18 @@ async def employee_detail(
         await callback.answer("Некорректный запрос", show_alert=True)
         return
     repo = UserRepo(session)
-    quota_repo = QuotaRepo(session)
-    record_repo = RecordRepo(session)
 
     user = await repo.get_by_telegram_id(user_id)
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
         return
 
-    limit = await quota_repo.get_limit(user.telegram_id, user.role)
-    used = await record_repo.count_used(user.telegram_id)
-
-    personal = await quota_repo.get_personal(user.telegram_id)
+    statuses = await QuotaService(session).get_status_many([user.telegram_id])
+    status = statuses[user.telegram_id]
     quota_info = (
-        f"Персональная: {personal.monthly_limit}"
-        if personal
-        else f"По роли: {limit}"
+        f"Персональная: {status.limit}"
+        if status.is_personal
+        else f"По роли: {status.limit}"
     )
 
     text = (
@@ -134,7 +204,7 @@ async def employee_detail(
         f"💼 {ROLE_LABELS.get(user.role, user.role)}\n"
         f"📱 {user.phone}\n"
         f"🆔 {user.telegram_id}\n"
-        f"📦 Квота: {quota_info} | Использовано: {used}/{limit}\n"
+        f"📦 Квота: {quota_info} | Использовано: {status.used}/{status.limit}\n"
         f"🛡 Админ: {'да' if user.is_admin else 'нет'}\n"
         f"📅 Регистрация: {fmt_dt(user.created_at, '%d.%m.%Y')}"
     )
@@ -156,16 +226,77 @@ async def employee_detail(
 
 
 @router.callback_query(F.data == "emp:back")
-async def employees_back(callback: CallbackQuery, session: AsyncSession) -> None:
-    repo = UserRepo(session)
-    users = await repo.get_all()
-    total_pages = max(1, (len(users) + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
-    page_users = users[:_USERS_PAGE_SIZE]
+async def employees_back(callback: CallbackQuery, session: AsyncSession, state: FSMContext) -> None:
+    data = await state.get_data()
+    text, kb, _ = await _users_picker(session, "emp", 0, data.get("user_search"))
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await callback.answer()
+
+
+@router.callback_query(F.data == "emp:near")
+async def employees_near_limit(callback: CallbackQuery, session: AsyncSession) -> None:
+    rows = await QuotaService(session).get_near_limit(_NEAR_LIMIT_THRESHOLD)
+    if not rows:
+        text = "Нет сотрудников, близких к исчерпанию квоты в этом месяце."
+    else:
+        lines = [f"⚠️ <b>Близки к лимиту</b> (осталось ≤ {_NEAR_LIMIT_THRESHOLD}): {len(rows)}\n"]
+        for user, status in rows[:_NEAR_LIMIT_MAX_LINES]:
+            lines.append(
+                f"👤 {user.full_name} ({ROLE_LABELS.get(user.role, user.role)}) — "
+                f"{status.used}/{status.limit}"
+            )
+        if len(rows) > _NEAR_LIMIT_MAX_LINES:
+            lines.append(f"…и ещё {len(rows) - _NEAR_LIMIT_MAX_LINES}")
+        text = "\n".join(lines)
+
+    from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="emp:back"))
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
+    await callback.answer()
+
+
+# ---------------------------------------------------------------------------
+# Поиск в списках выбора сотрудника
+# ---------------------------------------------------------------------------
+
+@router.callback_query(F.data.regexp(r"^(emp|quser|bcast):search$"))
+async def user_search_start(callback: CallbackQuery, state: FSMContext) -> None:
+    action = callback.data.split(":")[0]
+    if not await _picker_is_current(callback, state, action):
+        return
+    await state.update_data(user_search_action=action)
     await callback.message.edit_text(
-        f"Зарегистрировано сотрудников: <b>{len(users)}</b>",
-        parse_mode="HTML",
-        reply_markup=users_list_kb(page_users, 0, total_pages, "emp"),
+        "Введите фамилию, имя или отчество сотрудника (можно начало, например «петр ив»):",
+        reply_markup=cancel_kb(),
     )
+    await state.set_state(UserSearchStates.waiting_query)
+    await callback.answer()
+
+
+@router.message(UserSearchStates.waiting_query)
+async def user_search_query(message: Message, state: FSMContext, session: AsyncSession) -> None:
+    search = " ".join((message.text or "").split())
+    if not search or len(search) > _USER_SEARCH_MAX_LEN or user_ids_by_name(search) is None:
+        await message.answer(f"Введите слово из ФИО (не более {_USER_SEARCH_MAX_LEN} символов):")
+        return
+    data = await state.get_data()
+    action = data.get("user_search_action", "emp")
+    await state.update_data(user_search=search)
+    await state.set_state(_USER_PICKERS[action])  # назад в список, с которого начали поиск
+    text, kb, _ = await _users_picker(session, action, 0, search)
+    await message.answer(text, parse_mode="HTML", reply_markup=kb)
+
+
+@router.callback_query(F.data.regexp(r"^(emp|quser|bcast):nosearch$"))
+async def user_search_reset(callback: CallbackQuery, state: FSMContext, session: AsyncSession) -> None:
+    action = callback.data.split(":")[0]
+    if not await _picker_is_current(callback, state, action):
+        return
+    await state.update_data(user_search=None)
+    text, kb, _ = await _users_picker(session, action, 0)
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
     await callback.answer()
 
 
@@ -238,38 +369,75 @@ def _last_n_months(n: int) -> list[str]:
     return [(now - relativedelta(months=i)).strftime("%Y-%m") for i in range(n)]
 
 
-def _build_stats_text(records: list, user_map: dict, months: list[str], period_label: str) -> str:
-    if not records:
-        return f"📊 <b>{period_label}</b>\n\nДанных за этот период нет."
+async def _resolve_stats_target(target: str, read_session: AsyncSession) -> tuple[list[str], str] | None:
+    """Период статистики из callback: число месяцев или "YYYY-MM" → (месяцы, заголовок) или None."""
+    if re.match(r"^\d{4}-\d{2}$", target):
+        dt = datetime.strptime(target, "%Y-%m")
+        return [target], f"Статистика за {dt.strftime('%B %Y').capitalize()}"
+    try:
+        n = int(target)
+    except ValueError:
+        return None
 
-    # Группируем по сотруднику, внутри — по месяцу
-    by_user: dict[int, dict[str, list]] = defaultdict(lambda: defaultdict(list))
-    for rec in records:
-        by_user[rec.user_id][rec.month].append(rec)
+    all_months = await RecordRepo(read_session).get_stats_months()
+    if n == 0:
+        return all_months, "Статистика за весь период"
+    labels = {1: "текущий месяц", 3: "3 месяца", 6: "6 месяцев"}
+    return [m for m in _last_n_months(n) if m in all_months], f"Статистика за {labels.get(n, f'{n} мес.')}"
 
-    lines = [f"📊 <b>{period_label}</b>", f"Всего выдано: <b>{len(records)}</b>\n"]
-    for uid, months_data in sorted(by_user.items(), key=lambda x: -sum(len(v) for v in x[1].values())):
-        u = user_map.get(uid)
-        name = u.full_name if u else f"ID:{uid}"
-        role = ROLE_LABELS.get(u.role, u.role) if u else "—"
-        all_recs = [r for recs in months_data.values() for r in recs]
-        all_recs.sort(key=lambda r: r.created_at or datetime.min)
-        lines.append(f"👤 <b>{name}</b> ({role}) — {len(all_recs)} шт.")
 
-        # Каждая запись: №договора (дд.мм)
-        parts = [
-            f"№{r.site_number} ({fmt_dt(r.created_at, '%d.%m')})"
-            for r in all_recs
-        ]
-        lines.append("  " + " | ".join(parts))
-        lines.append("")
+def _month_breakdown(by_month: dict[str, int]) -> str:
+    return " · ".join(f"{month}: {by_month[month]}" for month in sorted(by_month, reverse=True))
 
-    return "\n".join(lines).strip()
+
+async def _show_stats_page(
+    callback: CallbackQuery, read_session: AsyncSession, target: str, page: int
+) -> None:
+    """Одна страница сводки: итоги периода и _STATS_PAGE_SIZE сотрудников по убыванию выдач."""
+    resolved = await _resolve_stats_target(target, read_session)
+    if resolved is None:
+        await callback.answer("Некорректный запрос", show_alert=True)
+        return
+    months, period_label = resolved
+
+    stats_repo = StatsRepo(read_session)
+    users_total = await stats_repo.count_users(months) if months else 0
+    if users_total == 0:
+        await callback.message.edit_text(f"📊 <b>{period_label}</b>\n\nДанных за этот период нет.", parse_mode="HTML")
+        await callback.answer()
+        return
+
+    total_pages = (users_total + _STATS_PAGE_SIZE - 1) // _STATS_PAGE_SIZE
+    page = max(0, min(page, total_pages - 1))
+    total, returned = await stats_repo.period_totals(months)
+    users = await stats_repo.users_page(months, page * _STATS_PAGE_SIZE, _STATS_PAGE_SIZE)
+
+    lines = [
+        f"📊 <b>{period_label}</b>",
+        f"Всего выдано: <b>{total}</b>, возвратов: {returned}",
+        f"Сотрудников: {users_total}\n",
+    ]
+    for n, s in enumerate(users, start=page * _STATS_PAGE_SIZE + 1):
+        name = s.full_name or f"ID:{s.user_id}"
+        role = ROLE_LABELS.get(s.role, s.role) if s.role else "—"
+        returns = f", возвратов {s.returned}" if s.returned else ""
+        lines.append(f"{n}. 👤 <b>{name}</b> ({role}) — {s.total} шт.{returns}")
+        # Разбивку по месяцам показываем для коротких периодов — за весь период она длиннее списка
+        if 1 < len(months) <= _STATS_MONTH_BREAKDOWN_MAX and len(s.by_month) > 1:
+            lines.append("  " + _month_breakdown(s.by_month))
+    lines.append("\nДоговоры сотрудника — по кнопке с его именем.")
+
+    await callback.message.edit_text(
+        "\n".join(lines),
+        parse_mode="HTML",
+        reply_markup=stats_page_kb(users, target, page, total_pages),
+    )
+    await callback.answer()
 
 
 @router.message(F.text == "📊 Статистика")
-async def stats_choose_period(message: Message, session: AsyncSession) -> None:
-    record_repo = RecordRepo(session)
+async def stats_choose_period(message: Message, read_session: AsyncSession) -> None:
+    record_repo = RecordRepo(read_session)
     months = await record_repo.get_stats_months()
     if not months:
         await message.answer("Нет данных для статистики.")
@@ -278,11 +446,11 @@ async def stats_choose_period(message: Message, session: AsyncSession) -> None:
 
 
 @router.callback_query(F.data.startswith("stats_period:"))
-async def stats_period(callback: CallbackQuery, session: AsyncSession) -> None:
+async def stats_period(callback: CallbackQuery, read_session: AsyncSession) -> None:
     value = callback.data.split(":", 1)[1]
 
     if value == "pick":
-        record_repo = RecordRepo(session)
+        record_repo = RecordRepo(read_session)
         months = await record_repo.get_stats_months()
         await callback.message.edit_text(
             "Выберите месяц:", reply_markup=months_kb(months, prefix="month")
@@ -290,54 +458,72 @@ async def stats_period(callback: CallbackQuery, session: AsyncSession) -> None:
         await callback.answer()
         return
 
-    record_repo = RecordRepo(session)
-    user_repo = UserRepo(session)
-    all_months = await record_repo.get_stats_months()
+    await _show_stats_page(callback, read_session, value, 0)
+
+
+@router.callback_query(F.data.startswith("month:"))
+async def stats_single_month(callback: CallbackQuery, read_session: AsyncSession) -> None:
+    month = callback.data.split(":", 1)[1]
+    if not re.match(r"^\d{4}-\d{2}$", month):
+        await callback.answer("Некорректный формат месяца", show_alert=True)
+        return
+    await _show_stats_page(callback, read_session, month, 0)
 
+
+@router.callback_query(F.data.startswith("stats_page:"))
+async def stats_page(callback: CallbackQuery, read_session: AsyncSession) -> None:
     try:
-        n = int(value)
+        _, target, page = callback.data.split(":")
+        page = int(page)
     except ValueError:
         await callback.answer("Некорректный запрос", show_alert=True)
         return
-    if n == 0:
-        target_months = all_months  # весь период
-        period_label = "Статистика за весь период"
-    else:
-        target_months = [m for m in _last_n_months(n) if m in all_months]
-        labels = {1: "текущий месяц", 3: "3 месяца", 6: "6 месяцев"}
-        period_label = f"Статистика за {labels.get(n, f'{n} мес.')}"
-
-    if not target_months:
-        await callback.message.edit_text("Нет данных за выбранный период.")
-        await callback.answer()
-        return
+    await _show_stats_page(callback, read_session, target, page)
 
-    records = await record_repo.get_by_months(target_months)
-    users = await user_repo.get_all()
-    user_map = {u.telegram_id: u for u in users}
-
-    text = _build_stats_text(records, user_map, target_months, period_label)
-    await callback.message.edit_text(text, parse_mode="HTML")
-    await callback.answer()
 
+@router.callback_query(F.data.startswith("stats_user:"))
+async def stats_user(callback: CallbackQuery, read_session: AsyncSession) -> None:
+    """Итоги и договоры одного сотрудника за период — грузятся только по запросу."""
+    try:
+        _, target, user_id, back_page, page = callback.data.split(":")
+        user_id, back_page, page = int(user_id), int(back_page), int(page)
+    except ValueError:
+        await callback.answer("Некорректный запрос", show_alert=True)
+        return
+    resolved = await _resolve_stats_target(target, read_session)
+    if resolved is None:
+        await callback.answer("Некорректный запрос", show_alert=True)
+        return
+    months, period_label = resolved
 
-@router.callback_query(F.data.startswith("month:"))
-async def stats_single_month(callback: CallbackQuery, session: AsyncSession) -> None:
-    month = callback.data.split(":", 1)[1]
-    if not re.match(r"^\d{4}-\d{2}$", month):
-        await callback.answer("Некорректный формат месяца", show_alert=True)
+    stats_repo = StatsRepo(read_session)
+    s = await stats_repo.user_stats(user_id, months)
+    if s is None:
+        await callback.answer("Сотрудник не найден", show_alert=True)
         return
 
-    record_repo = RecordRepo(session)
-    user_repo = UserRepo(session)
-    records = await record_repo.get_by_months([month])
-    users = await user_repo.get_all()
-    user_map = {u.telegram_id: u for u in users}
+    total_pages = max(1, (s.total + _STATS_CONTRACTS_PAGE_SIZE - 1) // _STATS_CONTRACTS_PAGE_SIZE)
+    page = max(0, min(page, total_pages - 1))
+    contracts = await stats_repo.user_contracts(
+        user_id, months, page * _STATS_CONTRACTS_PAGE_SIZE, _STATS_CONTRACTS_PAGE_SIZE
+    )
 
-    dt = datetime.strptime(month, "%Y-%m")
-    period_label = f"Статистика за {dt.strftime('%B %Y').capitalize()}"
-    text = _build_stats_text(records, user_map, [month], period_label)
-    await callback.message.edit_text(text, parse_mode="HTML")
+    role = ROLE_LABELS.get(s.role, s.role) if s.role else "—"
+    lines = [
+        f"👤 <b>{s.full_name}</b> ({role})",
+        f"{period_label}: выдано <b>{s.total}</b>, возвратов: {s.returned}",
+    ]
+    if len(s.by_month) > 1:
+        lines.append(_month_breakdown(s.by_month))
+    lines.append("")
+    # Каждая запись: №договора — дата выдачи
+    lines.extend(f"№{site} — {fmt_dt(created_at, '%d.%m.%Y')}" for site, created_at in contracts)
+
+    await callback.message.edit_text(
+        "\n".join(lines),
+        parse_mode="HTML",
+        reply_markup=stats_user_kb(target, user_id, back_page, page, total_pages),
+    )
     await callback.answer()
 
 
@@ -370,40 +556,30 @@ async def quota_role_selected(callback: CallbackQuery, state: FSMContext) -> Non
 async def quota_personal_selected(
     callback: CallbackQuery, state: FSMContext, session: AsyncSession
 ) -> None:
-    await state.update_data(quota_target="personal")
-    repo = UserRepo(session)
-    users = await repo.get_all()
-    if not users:
+    await state.update_data(quota_target="personal", user_search=None)
+    text, kb, total = await _users_picker(session, "quser", 0)
+    if not total:
         await callback.message.edit_text("Нет зарегистрированных сотрудников.")
         await state.clear()
         await callback.answer()
         return
-    total_pages = max(1, (len(users) + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
-    await callback.message.edit_text(
-        "Выберите сотрудника:",
-        reply_markup=users_list_kb(users[:_USERS_PAGE_SIZE], 0, total_pages, "quser"),
-    )
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
     await state.set_state(AdminQuotaStates.choose_user)
     await callback.answer()
 
 
 @router.callback_query(AdminQuotaStates.choose_user, F.data.startswith("quser:page:"))
 async def quota_personal_page(
-    callback: CallbackQuery, session: AsyncSession
+    callback: CallbackQuery, state: FSMContext, session: AsyncSession
 ) -> None:
     try:
         page = int(callback.data.split(":")[-1])
     except ValueError:
         await callback.answer("Некорректный запрос", show_alert=True)
         return
-    repo = UserRepo(session)
-    users = await repo.get_all()
-    total_pages = max(1, (len(users) + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
-    page = max(0, min(page, total_pages - 1))
-    page_users = users[page * _USERS_PAGE_SIZE: (page + 1) * _USERS_PAGE_SIZE]
-    await callback.message.edit_reply_markup(
-        reply_markup=users_list_kb(page_users, page, total_pages, "quser")
-    )
+    data = await state.get_data()
+    _, kb, _ = await _users_picker(session, "quser", page, data.get("user_search"))
+    await callback.message.edit_reply_markup(reply_markup=kb)
     await callback.answer()
 
 
@@ -559,21 +735,52 @@ async def admin_return_confirm(
 # ---------------------------------------------------------------------------
 
 @router.message(F.text == "📥 Выгрузить отчёт")
-async def export_choose_period(message: Message, session: AsyncSession) -> None:
-    record_repo = RecordRepo(session)
+async def export_choose_period(message: Message, read_session: AsyncSession) -> None:
+    record_repo = RecordRepo(read_session)
     months = await record_repo.get_stats_months()
     if not months:
         await message.answer("Нет данных для выгрузки.")
         return
-    await message.answer("Выберите период для выгрузки:", reply_markup=stats_period_kb(has_months=True, prefix="export_period"))
+    await message.answer("Выберите период для выгрузки:", reply_markup=stats_period_kb(has_months=True, prefix="export_period", delta=True))
+
+
+async def _enqueue_export(
+    callback: CallbackQuery,
+    months: list[str],
+    kind: str,
+    basename: str,
+    title: str,
+    delta: bool = False,
+) -> None:
+    """Ставит выгрузку в очередь; ход и файл присылает воркер export_jobs."""
+    admin_id = callback.from_user.id
+    delta_for = admin_id if delta else None
+    job = export_jobs.find(months, kind, delta_for)
+    if job is not None and admin_id in job.recipients:
+        await callback.answer("⏳ Этот отчёт уже формируется, подождите")
+        return
+    try:
+        job = export_jobs.submit(
+            months, kind, title, basename, admin_id, callback.message.chat.id, delta_for
+        )
+    except ExportQueueFull:
+        await callback.answer("Очередь выгрузок заполнена, попробуйте позже", show_alert=True)
+        return
+
+    await callback.answer()
+    status = await callback.message.answer(job.status_text(), reply_markup=export_job_kb(job.id))
+    export_jobs.attach_status(job, admin_id, status.message_id)
+    if job.finished:
+        # Отчёт нашёлся в кэше и ушёл раньше, чем мы успели отправить статус
+        await status.edit_text(job.status_text())
 
 
 @router.callback_query(F.data.startswith("export_period:"))
-async def export_period(callback: CallbackQuery, session: AsyncSession) -> None:
+async def export_period(callback: CallbackQuery, read_session: AsyncSession) -> None:
     value = callback.data.split(":", 1)[1]
 
     if value == "pick":
-        record_repo = RecordRepo(session)
+        record_repo = RecordRepo(read_session)
         months = await record_repo.get_stats_months()
         await callback.message.edit_text(
             "Выберите месяц:", reply_markup=months_kb(months, prefix="export_month")
@@ -581,52 +788,92 @@ async def export_period(callback: CallbackQuery, session: AsyncSession) -> None:
         await callback.answer()
         return
 
-    record_repo = RecordRepo(session)
-    all_months = await record_repo.get_stats_months()
+    if value == "delta":
+        # Дельта — плоский список изменений, его отдаём только в CSV
+        await callback.message.edit_text(
+            "Выберите формат:", reply_markup=export_format_kb(value, excel=False)
+        )
+        await callback.answer()
+        return
 
     try:
-        n = int(value)
+        int(value)
     except ValueError:
         await callback.answer("Некорректный запрос", show_alert=True)
         return
+    await callback.message.edit_text("Выберите формат:", reply_markup=export_format_kb(value))
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("export_month:"))
+async def export_single_month(callback: CallbackQuery) -> None:
+    month = callback.data.split(":", 1)[1]
+    if not re.match(r"^\d{4}-\d{2}$", month):
+        await callback.answer("Некорректный формат", show_alert=True)
+        return
+    await callback.message.edit_text("Выберите формат:", reply_markup=export_format_kb(month))
+    await callback.answer()
+
+
+async def _resolve_export_target(
+    target: str, read_session: AsyncSession
+) -> tuple[list[str], str, str] | None:
+    """Период выгрузки из callback: (месяцы, подпись, имя файла без расширения) или None."""
+    if re.match(r"^\d{4}-\d{2}$", target):
+        dt = datetime.strptime(target, "%Y-%m")
+        return [target], dt.strftime("%B %Y"), f"report_{target}"
+    try:
+        n = int(target)
+    except ValueError:
+        return None
+
+    all_months = await RecordRepo(read_session).get_stats_months()
     if n == 0:
-        target_months = all_months
-        caption_label = "весь период"
-        filename = "report_all.xlsx"
-    else:
-        target_months = [m for m in _last_n_months(n) if m in all_months]
-        labels = {1: "текущий месяц", 3: "3 месяца", 6: "6 месяцев"}
-        caption_label = labels.get(n, f"{n} мес.")
-        filename = f"report_last{n}m.xlsx"
+        return all_months, "весь период", "report_all"
+    labels = {1: "текущий месяц", 3: "3 месяца", 6: "6 месяцев"}
+    target_months = [m for m in _last_n_months(n) if m in all_months]
+    return target_months, labels.get(n, f"{n} мес."), f"report_last{n}m"
+
+
+@router.callback_query(F.data.startswith("export_fmt:"))
+async def export_format(callback: CallbackQuery, read_session: AsyncSession) -> None:
+    _, kind, target = callback.data.split(":", 2)
+    if target == "delta":
+        if kind not in ("csv", "csv.gz"):
+            await callback.answer("Некорректный запрос", show_alert=True)
+            return
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M")
+        await _enqueue_export(
+            callback, [], kind, f"changes_{stamp}", "Изменения с прошлой выгрузки", delta=True
+        )
+        return
 
+    resolved = await _resolve_export_target(target, read_session)
+    if kind not in EXPORT_KINDS or resolved is None:
+        await callback.answer("Некорректный запрос", show_alert=True)
+        return
+
+    target_months, caption_label, basename = resolved
     if not target_months:
         await callback.message.edit_text("Нет данных за выбранный период.")
         await callback.answer()
         return
 
-    await callback.answer("Генерирую отчёт...")
-    excel_bytes = await build_excel(session, target_months)
-    await callback.message.answer_document(
-        BufferedInputFile(excel_bytes, filename=filename),
-        caption=f"📥 Отчёт за {caption_label}",
-    )
+    await _enqueue_export(callback, target_months, kind, basename, f"Отчёт за {caption_label}")
 
 
-@router.callback_query(F.data.startswith("export_month:"))
-async def export_single_month(callback: CallbackQuery, session: AsyncSession) -> None:
-    month = callback.data.split(":", 1)[1]
-    if not re.match(r"^\d{4}-\d{2}$", month):
-        await callback.answer("Некорректный формат", show_alert=True)
+@router.callback_query(F.data.startswith("export_cancel:"))
+async def export_cancel(callback: CallbackQuery) -> None:
+    try:
+        job_id = int(callback.data.split(":", 1)[1])
+    except ValueError:
+        await callback.answer("Некорректный запрос", show_alert=True)
         return
-
-    await callback.answer("Генерирую отчёт...")
-    excel_bytes = await build_excel(session, [month])
-
-    dt = datetime.strptime(month, "%Y-%m")
-    await callback.message.answer_document(
-        BufferedInputFile(excel_bytes, filename=f"report_{month}.xlsx"),
-        caption=f"📥 Отчёт за {dt.strftime('%B %Y')}",
-    )
+    if not export_jobs.cancel(job_id, callback.from_user.id):
+        await callback.answer("Выгрузка уже завершена", show_alert=True)
+        return
+    await callback.message.edit_text("✖️ Выгрузка отменена.")
+    await callback.answer()
 
 
 # ---------------------------------------------------------------------------
@@ -654,39 +901,30 @@ async def broadcast_choose_all(callback: CallbackQuery, state: FSMContext) -> No
 async def broadcast_choose_one(
     callback: CallbackQuery, state: FSMContext, session: AsyncSession
 ) -> None:
-    repo = UserRepo(session)
-    users = await repo.get_all()
-    if not users:
+    await state.update_data(user_search=None)
+    text, kb, total = await _users_picker(session, "bcast", 0)
+    if not total:
         await callback.message.edit_text("Нет зарегистрированных сотрудников.")
         await state.clear()
         await callback.answer()
         return
-    total_pages = max(1, (len(users) + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
-    await callback.message.edit_text(
-        "Выберите сотрудника:",
-        reply_markup=users_list_kb(users[:_USERS_PAGE_SIZE], 0, total_pages, "bcast"),
-    )
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
     await state.set_state(BroadcastStates.choose_user)
     await callback.answer()
 
 
 @router.callback_query(BroadcastStates.choose_user, F.data.startswith("bcast:page:"))
 async def broadcast_user_page(
-    callback: CallbackQuery, session: AsyncSession
+    callback: CallbackQuery, state: FSMContext, session: AsyncSession
 ) -> None:
     try:
         page = int(callback.data.split(":")[-1])
     except ValueError:
         await callback.answer("Некорректный запрос", show_alert=True)
         return
-    repo = UserRepo(session)
-    users = await repo.get_all()
-    total_pages = max(1, (len(users) + _USERS_PAGE_SIZE - 1) // _USERS_PAGE_SIZE)
-    page = max(0, min(page, total_pages - 1))
-    page_users = users[page * _USERS_PAGE_SIZE: (page + 1) * _USERS_PAGE_SIZE]
-    await callback.message.edit_reply_markup(
-        reply_markup=users_list_kb(page_users, page, total_pages, "bcast")
-    )
+    data = await state.get_data()
+    _, kb, _ = await _users_picker(session, "bcast", page, data.get("user_search"))
+    await callback.message.edit_reply_markup(reply_markup=kb)
     await callback.answer()
 
 
@@ -808,43 +1046,74 @@ _RETURNS_PAGE_SIZE = 10
 
 
 @router.message(F.text == "📋 История возвратов")
-async def returns_history(message: Message, session: AsyncSession) -> None:
-    record_repo = RecordRepo(session)
-    total = await record_repo.count_cancelled_records()
+async def returns_history(message: Message, read_session: AsyncSession) -> None:
+    total = await RecordRepo(read_session).count_cancelled_records()
     if total == 0:
         await message.answer("Возвратов ещё не было.")
         return
-    records = await record_repo.get_cancelled_records(offset=0, limit=_RETURNS_PAGE_SIZE)
-    user_repo = UserRepo(session)
-    users = await user_repo.get_all()
-    user_map = {u.telegram_id: u for u in users}
-    total_pages = max(1, (total + _RETURNS_PAGE_SIZE - 1) // _RETURNS_PAGE_SIZE)
-    text = _build_returns_text(records, user_map, 0, total_pages, total)
-    await message.answer(text, parse_mode="HTML", reply_markup=_returns_page_kb(0, total_pages))
+    text, kb = await _returns_page(read_session, total, page=0)
+    await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
 
-@router.callback_query(F.data.startswith("returns:page:"))
-async def returns_history_page(callback: CallbackQuery, session: AsyncSession) -> None:
+@router.callback_query(F.data.startswith("returns:"))
+async def returns_history_page(callback: CallbackQuery, read_session: AsyncSession) -> None:
     try:
-        page = int(callback.data.split(":")[-1])
+        _, direction, page, cursor = callback.data.split(":", 3)
+        page = int(page)
+        position = decode_cursor(cursor)
     except ValueError:
         await callback.answer("Некорректный запрос", show_alert=True)
         return
-    record_repo = RecordRepo(session)
-    total = await record_repo.count_cancelled_records()
-    total_pages = max(1, (total + _RETURNS_PAGE_SIZE - 1) // _RETURNS_PAGE_SIZE)
-    page = max(0, min(page, total_pages - 1))
-    records = await record_repo.get_cancelled_records(
-        offset=page * _RETURNS_PAGE_SIZE, limit=_RETURNS_PAGE_SIZE
+    if direction not in ("prev", "next"):
+        await callback.answer("Некорректный запрос", show_alert=True)
+        return
+    total = await RecordRepo(read_session).count_cancelled_records()
+    text, kb = await _returns_page(
+        read_session,
+        total,
+        page,
+        after=position if direction == "next" else None,
+        before=position if direction == "prev" else None,
     )
-    user_repo = UserRepo(session)
-    users = await user_repo.get_all()
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await callback.answer()
+
+
+async def _returns_page(
+    read_session: AsyncSession,
+    total: int,
+    page: int,
+    after: Cursor | None = None,
+    before: Cursor | None = None,
+):
+    """
+    Страница возвратов по курсору (cancelled_at, id) граничной записи соседней страницы:
+    after — →, before — ←. total берётся из monthly_rollups, page — только для подписи.
+    """
+    record_repo = RecordRepo(read_session)
+    records, has_more = await record_repo.get_cancelled_records(
+        limit=_RETURNS_PAGE_SIZE, after=after, before=before
+    )
+    if (before is not None and not has_more) or (after is not None and not records):
+        # Листали к началу и дошли до него (или записи за курсором исчезли) — первая страница
+        return await _returns_page(read_session, total, page=0)
+    has_prev = after is not None or before is not None
+    has_next = has_more if before is None else True
+    total_pages = max(1, (total + _RETURNS_PAGE_SIZE - 1) // _RETURNS_PAGE_SIZE)
+    page = max(0, min(page if has_prev else 0, total_pages - 1))
+
+    # Имена только авторов записей этой страницы, а не вся таблица users
+    user_repo = UserRepo(read_session)
+    users = await user_repo.get_many([rec.user_id for rec in records])
     user_map = {u.telegram_id: u for u in users}
     text = _build_returns_text(records, user_map, page, total_pages, total)
-    await callback.message.edit_text(
-        text, parse_mode="HTML", reply_markup=_returns_page_kb(page, total_pages)
+    kb = _returns_page_kb(
+        page,
+        total_pages,
+        encode_cursor(records[0].cancelled_at, records[0].id) if has_prev and records else None,
+        encode_cursor(records[-1].cancelled_at, records[-1].id) if has_next and records else None,
     )
-    await callback.answer()
+    return text, kb
 
 
 def _build_returns_text(records, user_map, page, total_pages, total) -> str:
@@ -863,21 +1132,117 @@ def _build_returns_text(records, user_map, page, total_pages, total) -> str:
     return "\n".join(lines)
 
 
-def _returns_page_kb(page: int, total_pages: int):
+def _returns_page_kb(page: int, total_pages: int, prev_cursor: str | None, next_cursor: str | None):
     from aiogram.types import InlineKeyboardButton
     from aiogram.utils.keyboard import InlineKeyboardBuilder
     builder = InlineKeyboardBuilder()
     nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton(text="←", callback_data=f"returns:page:{page - 1}"))
+    if prev_cursor is not None:
+        nav.append(InlineKeyboardButton(text="←", callback_data=f"returns:prev:{page - 1}:{prev_cursor}"))
     nav.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="noop"))
-    if page < total_pages - 1:
-        nav.append(InlineKeyboardButton(text="→", callback_data=f"returns:page:{page + 1}"))
+    if next_cursor is not None:
+        nav.append(InlineKeyboardButton(text="→", callback_data=f"returns:next:{page + 1}:{next_cursor}"))
     if nav:
         builder.row(*nav)
     return builder.as_markup()
 
 
+# ---------------------------------------------------------------------------
+# Поиск по сотрудникам и договорам
+# ---------------------------------------------------------------------------
+
+@router.message(F.text == "🔎 Поиск")
+async def search_start(message: Message, state: FSMContext) -> None:
+    await message.answer(
+        "Введите ФИО, телефон или номер договора (можно начало):",
+        reply_markup=cancel_kb(),
+    )
+    await state.set_state(AdminSearchStates.waiting_query)
+
+
+@router.message(AdminSearchStates.waiting_query)
+async def search_query(message: Message, state: FSMContext, read_session: AsyncSession) -> None:
+    search = " ".join((message.text or "").split())
+    if not search or len(search) > _SEARCH_MAX_LEN:
+        await message.answer(f"Введите от 1 до {_SEARCH_MAX_LEN} символов:")
+        return
+    await state.clear()
+
+    repo = SearchRepo(read_session)
+    users = await repo.users(search, _SEARCH_USERS_LIMIT)
+    records = await repo.records(search, _SEARCH_RECORDS_LIMIT)
+    if not users and not records:
+        await message.answer(f"По запросу «{escape(search)}» ничего не найдено.")
+        return
+
+    lines = [f"🔎 <b>Поиск:</b> «{escape(search)}»"]
+    if users:
+        lines.append("\n<b>Сотрудники</b>")
+        for u in users:
+            lines.append(f"👤 {u.full_name} ({ROLE_LABELS.get(u.role, u.role)}) — 📱 {u.phone}")
+    if records:
+        lines.append("\n<b>Договоры</b>")
+        for rec in records:
+            status = " — ↩️ возвращена" if rec.is_cancelled else ""
+            lines.append(
+                f"📋 №{rec.site_number} — {rec.full_name or f'ID:{rec.user_id}'}, "
+                f"{fmt_dt(rec.created_at, '%d.%m.%Y')}{status}"
+            )
+
+    from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+    builder = InlineKeyboardBuilder()
+    for u in users:
+        builder.row(InlineKeyboardButton(text=f"👤 {u.full_name}", callback_data=f"emp:user:{u.telegram_id}"))
+    await message.answer("\n".join(lines), parse_mode="HTML", reply_markup=builder.as_markup())
+
+
+# ---------------------------------------------------------------------------
+# Обслуживание
+# ---------------------------------------------------------------------------
+
+@router.message(Command("reconcile"))
+async def reconcile_counters(message: Message, session: AsyncSession) -> None:
+    """Пересобирает итоги по месяцам (квоты, статистика) по таблице records."""
+    record_repo = RecordRepo(session)
+    mismatched = await record_repo.rebuild_rollups()
+    await message.answer(
+        f"✅ Итоги по месяцам пересобраны. Исправлено расхождений: <b>{mismatched}</b>",
+        parse_mode="HTML",
+    )
+
+
+def _cache_stats_line(title: str, stats: dict[str, int]) -> str:
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] * 100 / lookups if lookups else 0.0
+    return (
+        f"<b>{title}</b>: записей {stats['size']}, "
+        f"попаданий {stats['hits']}, промахов {stats['misses']} ({hit_rate:.0f}% из кэша)"
+    )
+
+
+@router.message(Command("cache"))
+async def cache_stats(message: Message) -> None:
+    """Статистика кэшей процесса: сколько обращений к БД они сэкономили."""
+    report_stats = report_cache.stats()
+    lines = [
+        _cache_stats_line("Пользователи", user_cache.stats()),
+        _cache_stats_line("Лимиты квот", quota_resolver.stats()),
+        f"Перезагрузок кэша лимитов после правок в обход бота: {quota_resolver.reloads}",
+        _cache_stats_line("Отчёты", report_stats),
+        _cache_stats_line("Отправленные отчёты (file_id)", report_file_ids.stats()),
+        f"Отчёты на диске: {report_stats['bytes'] / 1024 / 1024:.1f} МБ",
+    ]
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+
+@router.message(Command("clear_reports"))
+async def clear_reports(message: Message) -> None:
+    """Удаляет все готовые отчёты из кэша на диске."""
+    removed = report_cache.clear()
+    await message.answer(f"🗑 Кэш отчётов очищен. Удалено файлов: <b>{removed}</b>", parse_mode="HTML")
+
+
 # ---------------------------------------------------------------------------
 # Отмена FSM (admin)
 # ---------------------------------------------------------------------------
@@ -7,8 +7,9 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from bot.database.models import ROLE_LABELS, User
-from bot.database.repositories.record_repo import RecordRepo
+from bot.database.cache import UserSnapshot
+from bot.database.models import ROLE_LABELS
+from bot.database.repositories.record_repo import Cursor, RecordRepo, decode_cursor, encode_cursor
 from bot.keyboards.employee import (
     confirm_kb,
     history_pagination_kb,
@@ -24,7 +25,7 @@ _SITE_RE = re.compile(r"^[\w\-/\.]{1,100}$")
 _HISTORY_PAGE_SIZE = 15  # записей на страницу (для группировки ~3 месяца)
 
 
-def _require_user(user: User | None) -> bool:
+def _require_user(user: UserSnapshot | None) -> bool:
     return user is not None
 
 
@@ -33,16 +34,15 @@ def _require_user(user: User | None) -> bool:
 # ---------------------------------------------------------------------------
 
 @router.message(F.text == "📊 Мой кабинет")
-async def cabinet(message: Message, user: User | None, is_admin: bool, session: AsyncSession) -> None:
+async def cabinet(message: Message, user: UserSnapshot | None, is_admin: bool, session: AsyncSession) -> None:
     if not _require_user(user):
         await message.answer("Сначала зарегистрируйтесь. Отправьте /start")
         return
 
     service = QuotaService(session)
-    status = await service.get_status(user)
-
-    record_repo = RecordRepo(session)
-    total = await record_repo.count_history(user.telegram_id)
+    snapshot = await service.get_cabinet(user, history_limit=_HISTORY_PAGE_SIZE)
+    status = snapshot.status
+    total = snapshot.total
 
     text = (
         f"👤 <b>{user.full_name}</b>\n"
@@ -52,29 +52,46 @@ async def cabinet(message: Message, user: User | None, is_admin: bool, session:
     )
     await message.answer(text, parse_mode="HTML")
 
-    # Передаём уже посчитанный total, чтобы не делать второй запрос
-    await _send_history_page(message, user, session, page=0, edit=False, total=total)
+    # Передаём уже загруженные total и первую страницу, чтобы не делать повторных запросов
+    await _send_history_page(message, user, session, total=total, records=snapshot.history)
 
 
 async def _send_history_page(
     message: Message,
-    user: User,
+    user: UserSnapshot,
     session: AsyncSession,
-    page: int,
+    page: int = 0,
     edit: bool = False,
     total: int | None = None,
+    records: list | None = None,
+    after: Cursor | None = None,
+    before: Cursor | None = None,
 ) -> None:
+    """
+    Страница истории. Первая — records из кабинета или новые первые;
+    дальше — по курсору граничной записи соседней страницы (after — →, before — ←).
+    page нужен только для подписи «N / M».
+    """
     record_repo = RecordRepo(session)
     if total is None:
         total = await record_repo.count_history(user.telegram_id)
     total_pages = max(1, (total + _HISTORY_PAGE_SIZE - 1) // _HISTORY_PAGE_SIZE)
-    page = max(0, min(page, total_pages - 1))
 
-    records = await record_repo.get_history(
-        user.telegram_id,
-        offset=page * _HISTORY_PAGE_SIZE,
-        limit=_HISTORY_PAGE_SIZE,
-    )
+    if records is not None:
+        has_prev, has_next = False, total > len(records)
+    else:
+        records, has_more = await record_repo.get_history(
+            user.telegram_id, limit=_HISTORY_PAGE_SIZE, after=after, before=before
+        )
+        if (before is not None and not has_more) or (after is not None and not records):
+            # Листали к началу и дошли до него (или записи за курсором вернули) — первая страница
+            await _send_history_page(message, user, session, edit=edit, total=total)
+            return
+        has_prev = after is not None or before is not None
+        has_next = has_more if before is None else True
+    if not has_prev:
+        page = 0
+    page = max(0, min(page, total_pages - 1))
 
     if not records:
         await message.answer("История пуста.")
@@ -97,7 +114,14 @@ async def _send_history_page(
         lines.append("")
 
     text = "\n".join(lines).strip()
-    kb = history_pagination_kb(page, total_pages) if total_pages > 1 else None
+    kb = None
+    if has_prev or has_next:
+        kb = history_pagination_kb(
+            page,
+            total_pages,
+            encode_cursor(records[0].created_at, records[0].id) if has_prev else None,
+            encode_cursor(records[-1].created_at, records[-1].id) if has_next else None,
+        )
 
     if edit:
         await message.edit_text(text, parse_mode="HTML", reply_markup=kb)
@@ -105,19 +129,32 @@ async def _send_history_page(
         await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
 
-@router.callback_query(F.data.startswith("history:page:"))
+@router.callback_query(F.data.startswith("history:"))
 async def history_page_callback(
-    callback: CallbackQuery, user: User | None, session: AsyncSession
+    callback: CallbackQuery, user: UserSnapshot | None, session: AsyncSession
 ) -> None:
     if not _require_user(user):
         await callback.answer("Не зарегистрированы", show_alert=True)
         return
     try:
-        page = int(callback.data.split(":")[-1])
+        _, direction, page, cursor = callback.data.split(":", 3)
+        page = int(page)
+        position = decode_cursor(cursor)
     except ValueError:
         await callback.answer("Некорректный запрос", show_alert=True)
         return
-    await _send_history_page(callback.message, user, session, page=page, edit=True)
+    if direction not in ("prev", "next"):
+        await callback.answer("Некорректный запрос", show_alert=True)
+        return
+    await _send_history_page(
+        callback.message,
+        user,
+        session,
+        page=page,
+        edit=True,
+        after=position if direction == "next" else None,
+        before=position if direction == "prev" else None,
+    )
     await callback.answer()
 
 
@@ -126,7 +163,7 @@ async def history_page_callback(
 # ---------------------------------------------------------------------------
 
 @router.message(F.text == "➕ Взять дровницу")
-async def take_start(message: Message, user: User | None, session: AsyncSession, state: FSMContext) -> None:
+async def take_start(message: Message, user: UserSnapshot | None, session: AsyncSession, state: FSMContext) -> None:
     if not _require_user(user):
         await message.answer("Сначала зарегистрируйтесь. Отправьте /start")
         return
@@ -150,7 +187,7 @@ async def take_start(message: Message, user: User | None, session: AsyncSession,
 
 @router.message(TakeStates.waiting_site_number)
 async def take_site_number(
-    message: Message, state: FSMContext, user: User | None, session: AsyncSession
+    message: Message, state: FSMContext, user: UserSnapshot | None, session: AsyncSession
 ) -> None:
     text = (message.text or "").strip()
     if not text or len(text) > 100:
@@ -193,7 +230,7 @@ async def take_site_number(
 async def take_confirm(
     callback: CallbackQuery,
     state: FSMContext,
-    user: User | None,
+    user: UserSnapshot | None,
     is_admin: bool,
     session: AsyncSession,
 ) -> None:
@@ -205,17 +242,19 @@ async def take_confirm(
     site_number = data.get("site_number", "")
     await state.clear()
 
-    user_id = user.telegram_id
-    user_role = user.role
     service = QuotaService(session)
     record = await service.take(user, site_number)
+    status = await service.get_status(user) if record is not None else None
+    # INSERT держит блокировку записи SQLite до commit — фиксируем до запросов к Telegram,
+    # иначе все выдачи ждали бы сетевых задержек друг друга. Middleware после этого
+    # видит, что транзакции нет, и второй раз не коммитит
+    await session.commit()
 
     if record is None:
         await callback.message.edit_text("Квота исчерпана. Обратитесь к администратору.")
         await callback.answer()
         return
 
-    status = await service.get_status_for(user_id, user_role)
     await callback.message.edit_text(
         f"✅ Дровница выдана!\n\n"
         f"📋 №{site_number}\n"
@@ -231,7 +270,7 @@ async def take_confirm(
 # ---------------------------------------------------------------------------
 
 @router.message(F.text == "↩️ Вернуть дровницу")
-async def return_start(message: Message, user: User | None, state: FSMContext) -> None:
+async def return_start(message: Message, user: UserSnapshot | None, state: FSMContext) -> None:
     if not _require_user(user):
         await message.answer("Сначала зарегистрируйтесь. Отправьте /start")
         return
@@ -270,7 +309,7 @@ async def return_site_number(message: Message, state: FSMContext) -> None:
 async def return_confirm(
     callback: CallbackQuery,
     state: FSMContext,
-    user: User | None,
+    user: UserSnapshot | None,
     is_admin: bool,
     session: AsyncSession,
 ) -> None:
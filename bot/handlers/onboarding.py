@@ -121,7 +121,7 @@ async def process_role(
         full_name=full_name,
         phone=phone,
         role=role,
-        is_admin=callback.from_user.id in settings.admin_id_list,
+        is_admin=callback.from_user.id in settings.admin_id_set,
     )
     await state.clear()
 
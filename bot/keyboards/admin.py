@@ -9,7 +9,8 @@ def admin_menu_kb() -> ReplyKeyboardMarkup:
         [KeyboardButton(text="👥 Сотрудники"), KeyboardButton(text="📊 Статистика")],
         [KeyboardButton(text="🔧 Квоты"), KeyboardButton(text="↩️ Вернуть (админ)")],
         [KeyboardButton(text="📥 Выгрузить отчёт"), KeyboardButton(text="📢 Рассылка")],
-        [KeyboardButton(text="◀️ Назад"), KeyboardButton(text="📋 История возвратов")],
+        [KeyboardButton(text="🔎 Поиск"), KeyboardButton(text="📋 История возвратов")],
+        [KeyboardButton(text="◀️ Назад")],
     ]
     return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
@@ -45,8 +46,10 @@ def quota_target_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def stats_period_kb(has_months: bool, prefix: str = "stats_period") -> InlineKeyboardMarkup:
-    """Выбор периода для статистики или экспорта."""
+def stats_period_kb(
+    has_months: bool, prefix: str = "stats_period", delta: bool = False
+) -> InlineKeyboardMarkup:
+    """Выбор периода для статистики или экспорта. delta — кнопка «изменения с прошлой выгрузки»."""
     builder = InlineKeyboardBuilder()
     builder.row(
         InlineKeyboardButton(text="📅 Текущий месяц", callback_data=f"{prefix}:1"),
@@ -60,6 +63,10 @@ def stats_period_kb(has_months: bool, prefix: str = "stats_period") -> InlineKey
         builder.row(
             InlineKeyboardButton(text="🗓 Конкретный месяц", callback_data=f"{prefix}:pick")
         )
+    if delta:
+        builder.row(
+            InlineKeyboardButton(text="🔄 Изменения с прошлой выгрузки", callback_data=f"{prefix}:delta")
+        )
     builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
     return builder.as_markup()
 
@@ -76,14 +83,23 @@ def months_kb(months: list[str], prefix: str = "month") -> InlineKeyboardMarkup:
 
 
 def users_list_kb(
-    users: list, page: int, total_pages: int, action: str
+    users: list,
+    page: int,
+    total_pages: int,
+    action: str,
+    statuses: dict | None = None,
+    extra_buttons: list[InlineKeyboardButton] | None = None,
 ) -> InlineKeyboardMarkup:
-    """Пагинированный список сотрудников."""
+    """Пагинированный список сотрудников. statuses — {telegram_id: QuotaStatus} для «used/limit»."""
     builder = InlineKeyboardBuilder()
     for user in users:
+        text = f"{user.full_name} ({ROLE_LABELS.get(user.role, user.role)})"
+        status = statuses.get(user.telegram_id) if statuses else None
+        if status is not None:
+            text += f" — {status.used}/{status.limit}"
         builder.row(
             InlineKeyboardButton(
-                text=f"{user.full_name} ({ROLE_LABELS.get(user.role, user.role)})",
+                text=text,
                 callback_data=f"{action}:user:{user.telegram_id}",
             )
         )
@@ -101,6 +117,14 @@ def users_list_kb(
         )
     if nav_buttons:
         builder.row(*nav_buttons)
+    for button in extra_buttons or []:
+        builder.row(button)
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
+    return builder.as_markup()
+
+
+def cancel_kb() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
     return builder.as_markup()
 
@@ -112,3 +136,80 @@ def confirm_kb(action: str) -> InlineKeyboardMarkup:
         InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"),
     )
     return builder.as_markup()
+
+
+def export_job_kb(job_id: int) -> InlineKeyboardMarkup:
+    """Кнопка отмены под сообщением о ходе выгрузки."""
+    builder = InlineKeyboardBuilder()
+    builder.row(
+        InlineKeyboardButton(text="✖️ Отменить выгрузку", callback_data=f"export_cancel:{job_id}")
+    )
+    return builder.as_markup()
+
+
+def export_format_kb(target: str, excel: bool = True) -> InlineKeyboardMarkup:
+    """Выбор формата выгрузки. target — выбранный период: число месяцев, "YYYY-MM" или "delta"."""
+    builder = InlineKeyboardBuilder()
+    if excel:
+        builder.row(InlineKeyboardButton(text="📗 Excel (.xlsx)", callback_data=f"export_fmt:xlsx:{target}"))
+    builder.row(
+        InlineKeyboardButton(text="📄 CSV", callback_data=f"export_fmt:csv:{target}"),
+        InlineKeyboardButton(text="🗜 CSV (gzip)", callback_data=f"export_fmt:csv.gz:{target}"),
+    )
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel"))
+    return builder.as_markup()
+
+
+def stats_page_kb(users: list, target: str, page: int, total_pages: int) -> InlineKeyboardMarkup:
+    """Страница статистики: сотрудники страницы (→ их договоры) и ←/→. target — период из stats_period."""
+    builder = InlineKeyboardBuilder()
+    for s in users:
+        builder.row(
+            InlineKeyboardButton(
+                text=f"👤 {s.full_name or s.user_id} — {s.total}",
+                callback_data=f"stats_user:{target}:{s.user_id}:{page}:0",
+            )
+        )
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(
+            InlineKeyboardButton(text="←", callback_data=f"stats_page:{target}:{page - 1}")
+        )
+    nav_buttons.append(
+        InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="noop")
+    )
+    if page < total_pages - 1:
+        nav_buttons.append(
+            InlineKeyboardButton(text="→", callback_data=f"stats_page:{target}:{page + 1}")
+        )
+    builder.row(*nav_buttons)
+    return builder.as_markup()
+
+
+def stats_user_kb(
+    target: str, user_id: int, back_page: int, page: int, total_pages: int
+) -> InlineKeyboardMarkup:
+    """Договоры сотрудника: ←/→ по договорам и возврат на страницу back_page сводки."""
+    builder = InlineKeyboardBuilder()
+    if total_pages > 1:
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    text="←", callback_data=f"stats_user:{target}:{user_id}:{back_page}:{page - 1}"
+                )
+            )
+        nav_buttons.append(
+            InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="noop")
+        )
+        if page < total_pages - 1:
+            nav_buttons.append(
+                InlineKeyboardButton(
+                    text="→", callback_data=f"stats_user:{target}:{user_id}:{back_page}:{page + 1}"
+                )
+            )
+        builder.row(*nav_buttons)
+    builder.row(
+        InlineKeyboardButton(text="◀️ К списку", callback_data=f"stats_page:{target}:{back_page}")
+    )
+    return builder.as_markup()
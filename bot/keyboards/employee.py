@@ -22,14 +22,17 @@ def confirm_kb(action: str) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def history_pagination_kb(page: int, total_pages: int) -> InlineKeyboardMarkup:
+def history_pagination_kb(
+    page: int, total_pages: int, prev_cursor: str | None, next_cursor: str | None
+) -> InlineKeyboardMarkup:
+    """←/→ по истории. Курсоры — граничные записи страницы (encode_cursor), None — листать некуда."""
     builder = InlineKeyboardBuilder()
     buttons = []
-    if page > 0:
-        buttons.append(InlineKeyboardButton(text="←", callback_data=f"history:page:{page - 1}"))
+    if prev_cursor is not None:
+        buttons.append(InlineKeyboardButton(text="←", callback_data=f"history:prev:{page - 1}:{prev_cursor}"))
     buttons.append(InlineKeyboardButton(text=f"{page + 1} / {total_pages}", callback_data="noop"))
-    if page < total_pages - 1:
-        buttons.append(InlineKeyboardButton(text="→", callback_data=f"history:page:{page + 1}"))
+    if next_cursor is not None:
+        buttons.append(InlineKeyboardButton(text="→", callback_data=f"history:next:{page + 1}:{next_cursor}"))
     builder.row(*buttons)
     return builder.as_markup()
 
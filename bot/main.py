@@ -11,10 +11,19 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import BotCommand
 
 from bot.config import settings
-from bot.database.base import AsyncSessionLocal, init_db
+from bot.database.base import (
+    AsyncSessionLocal,
+    ReadSessionLocal,
+    engine,
+    get_pragma_report,
+    init_db,
+    read_engine,
+)
 from bot.database.repositories.quota_repo import QuotaRepo
 from bot.handlers import admin, employee, fallback, onboarding
 from bot.middlewares.auth import AuthMiddleware
+from bot.services.export_jobs import export_jobs
+from bot.services.export_service import shutdown_executor
 
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "bot.log")
@@ -45,16 +54,36 @@ logging.getLogger("aiogram").setLevel(logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _verify_quota_cache_periodically() -> None:
+    """Сверяет кэш лимитов с БД: ловит правки таблицы quotas в обход бота."""
+    while True:
+        await asyncio.sleep(settings.quota_verify_interval)
+        try:
+            async with ReadSessionLocal() as session:
+                if await QuotaRepo(session).verify_cache():
+                    logger.warning("Quota cache was out of sync with the database, reloaded")
+        except Exception:
+            logger.exception("Quota cache verification failed")
+
 
 async def on_startup(bot: Bot) -> None:
     logger.info("Initialising database…")
     await init_db()
+    logger.info("SQLite pragmas: %s", await get_pragma_report())
 
-    # Засеваем дефолтные квоты по ролям
+    # Засеваем дефолтные квоты по ролям и загружаем все лимиты в кэш
     async with AsyncSessionLocal() as session:
         repo = QuotaRepo(session)
         await repo.seed_defaults()
         await session.commit()
+        await repo.load_cache()
+
+    task = asyncio.create_task(_verify_quota_cache_periodically())
+    _background_tasks.add(task)
+    _background_tasks.update(export_jobs.start(bot, workers=settings.export_workers))
 
     # Регистрируем команды — появится кнопка «/» в поле ввода
     await bot.set_my_commands([
@@ -65,6 +94,14 @@ async def on_startup(bot: Bot) -> None:
     logger.info("Bot started. Admin IDs: %s", settings.admin_id_list)
 
 
+async def on_shutdown() -> None:
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    shutdown_executor()
+
+
 async def main() -> None:
     bot = Bot(
         token=settings.bot_token,
@@ -82,12 +119,16 @@ async def main() -> None:
     dp.include_router(fallback.router)  # всегда последним
 
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     logger.info("Starting polling…")
     try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
         await bot.session.close()
+        # Пул read-only движка держит соединения (и потоки aiosqlite) открытыми
+        await read_engine.dispose()
+        await engine.dispose()
         logger.info("Bot stopped.")
 
 
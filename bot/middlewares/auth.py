@@ -5,15 +5,16 @@ from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Update
 
 from bot.config import settings
-from bot.database.base import AsyncSessionLocal
+from bot.database.base import AsyncSessionLocal, LazySession, ReadSessionLocal
 from bot.database.repositories.user_repo import UserRepo
 
 
 class AuthMiddleware(BaseMiddleware):
     """
     Для каждого апдейта:
-    - Открывает сессию БД и кладёт её в data['session']
-    - Загружает объект пользователя → data['user'] (None если не зарегистрирован)
+    - Кладёт ленивую сессию БД в data['session'] — соединение берётся при первом запросе
+    - Кладёт ленивую read-only сессию для отчётов в data['read_session']
+    - Загружает снимок пользователя из кэша/БД → data['user'] (None если не зарегистрирован)
     - Устанавливает data['is_admin'] по .env ADMIN_IDS или флагу в БД
     """
 
@@ -23,16 +24,18 @@ class AuthMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: dict[str, Any],
     ) -> Any:
-        async with AsyncSessionLocal() as session:
-            data["session"] = session
-
+        session = LazySession(AsyncSessionLocal)
+        read_session = LazySession(ReadSessionLocal)
+        data["session"] = session
+        data["read_session"] = read_session
+        try:
             telegram_user = data.get("event_from_user")
             if telegram_user:
                 repo = UserRepo(session)
-                user = await repo.get_by_telegram_id(telegram_user.id)
+                user = await repo.get_snapshot(telegram_user.id)
                 data["user"] = user
                 data["is_admin"] = (
-                    telegram_user.id in settings.admin_id_list
+                    telegram_user.id in settings.admin_id_set
                     or (user is not None and user.is_admin)
                 )
             else:
@@ -41,8 +44,14 @@ class AuthMiddleware(BaseMiddleware):
 
             try:
                 result = await handler(event, data)
-                await session.commit()
+                # commit/rollback только если апдейт действительно обращался к БД
+                if session.in_transaction():
+                    await session.commit()
                 return result
             except Exception:
-                await session.rollback()
+                if session.in_transaction():
+                    await session.rollback()
                 raise
+        finally:
+            await read_session.close()
+            await session.close()
@@ -0,0 +1,297 @@
+import asyncio
+import itertools
+import logging
+import os
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.types import FSInputFile, InlineKeyboardMarkup
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.config import settings
+from bot.database.base import AsyncSessionLocal, ReadSessionLocal
+from bot.database.cache import MISSING
+from bot.database.repositories.export_mark_repo import ExportMarkRepo
+from bot.keyboards.admin import export_job_kb
+from bot.services.export_service import (
+    ExportCancelled,
+    ExportProgress,
+    build_csv,
+    build_delta_csv,
+    build_excel,
+    report_key,
+)
+from bot.services.report_cache import report_file_ids
+
+logger = logging.getLogger(__name__)
+
+# Telegram ограничивает частоту правок сообщения — статус обновляем не чаще раза в 2 с
+_PROGRESS_INTERVAL = 2.0
+
+
+class ExportQueueFull(Exception):
+    """В очереди выгрузок нет места."""
+
+
+@dataclass(eq=False)
+class ExportJob:
+    id: int
+    months: list[str]
+    kind: str  # один из EXPORT_KINDS
+    title: str  # "Отчёт за 3 месяца"
+    basename: str  # имя файла без расширения: "report_last3m"
+    key: tuple
+    # Дельта-выгрузка для этого админа: months пуст, строки — изменения с его отметки
+    delta_for: int | None = None
+    # admin_id → [chat_id, message_id сообщения о статусе или None, пока оно не отправлено]
+    recipients: dict[int, list[int | None]] = field(default_factory=dict)
+    progress: ExportProgress = field(default_factory=ExportProgress)
+    state: str = "queued"  # queued / running / done / failed / cancelled
+    note: str | None = None  # пояснение к итоговому статусу
+    # Новая отметка дельта-выгрузки (records.changed_seq), пишется после доставки
+    new_mark: int | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    def status_text(self) -> str:
+        p = self.progress
+        if self.state == "queued":
+            return f"⏳ {self.title}: в очереди"
+        if self.state == "done":
+            return f"✅ {self.title}: {self.note or 'готово'}"
+        if self.state == "failed":
+            return f"❌ {self.title}: не удалось сформировать отчёт"
+        if self.state == "cancelled":
+            return f"✖️ {self.title}: выгрузка отменена"
+        if self.kind != "xlsx":
+            return f"⏳ {self.title}: записано {p.rows_fetched} строк"
+        if not p.rendering:
+            return f"⏳ {self.title}: выборка данных — {p.rows_fetched} строк"
+        if settings.export_executor == "thread":
+            return (
+                f"⏳ {self.title}: записано {p.rows_written} из {p.rows_fetched} строк, "
+                f"месяцев {p.months_done} из {p.months_total}"
+            )
+        return f"⏳ {self.title}: формирование файла ({p.rows_fetched} строк)"
+
+
+async def send_report(
+    bot: Bot, chat_id: int, report_path: str, filename: str, caption: str, cached: bool = True
+) -> None:
+    """
+    Отправляет отчёт; если такой же файл уже уходил в Telegram — по file_id, без загрузки.
+    cached=False — файл временный, его file_id запоминать незачем.
+    """
+    if not cached:
+        await bot.send_document(chat_id, FSInputFile(report_path, filename=filename), caption=caption)
+        return
+
+    key = (os.path.basename(report_path), filename)
+    file_id = report_file_ids.get(key)
+    if file_id is not MISSING:
+        try:
+            await bot.send_document(chat_id, file_id, caption=caption)
+            return
+        except TelegramBadRequest:
+            report_file_ids.invalidate(key)  # file_id недействителен — загружаем заново
+
+    sent = await bot.send_document(chat_id, FSInputFile(report_path, filename=filename), caption=caption)
+    report_file_ids.set(key, sent.document.file_id)
+
+
+class ExportJobRunner:
+    """
+    Очередь выгрузок и воркеры. Хендлер ставит задачу и сразу отвечает, воркер
+    собирает отчёт, правит сообщение о статусе и присылает файл.
+    Одинаковый отчёт собирается один раз: повторный запрос другого админа
+    добавляет его в получатели уже поставленной задачи.
+    """
+
+    def __init__(self, max_queued: int) -> None:
+        self._queue: asyncio.Queue[ExportJob] = asyncio.Queue(maxsize=max_queued)
+        self._jobs: dict[int, ExportJob] = {}
+        self._by_key: dict[tuple, ExportJob] = {}
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _key(months: list[str], kind: str, delta_for: int | None) -> tuple:
+        # Дельта зависит от отметки конкретного админа — такие задачи не объединяются
+        if delta_for is not None:
+            return "delta", kind, delta_for
+        return report_key(months, kind)
+
+    def find(self, months: list[str], kind: str, delta_for: int | None = None) -> ExportJob | None:
+        return self._by_key.get(self._key(months, kind, delta_for))
+
+    def submit(
+        self,
+        months: list[str],
+        kind: str,
+        title: str,
+        basename: str,
+        admin_id: int,
+        chat_id: int,
+        delta_for: int | None = None,
+    ) -> ExportJob:
+        """Ставит выгрузку в очередь или присоединяет админа к такой же. ExportQueueFull если мест нет."""
+        job = self.find(months, kind, delta_for)
+        if job is None:
+            job = ExportJob(
+                id=next(self._ids),
+                months=months,
+                kind=kind,
+                title=title,
+                basename=basename,
+                key=self._key(months, kind, delta_for),
+                delta_for=delta_for,
+            )
+            try:
+                self._queue.put_nowait(job)
+            except asyncio.QueueFull:
+                raise ExportQueueFull from None
+            self._jobs[job.id] = job
+            self._by_key[job.key] = job
+        job.recipients[admin_id] = [chat_id, None]
+        return job
+
+    def attach_status(self, job: ExportJob, admin_id: int, message_id: int) -> None:
+        recipient = job.recipients.get(admin_id)
+        if recipient is not None:
+            recipient[1] = message_id
+
+    def cancel(self, job_id: int, admin_id: int) -> bool:
+        """Снимает админа с задачи; задача без получателей отменяется. False если она уже завершена."""
+        job = self._jobs.get(job_id)
+        if job is None or job.recipients.pop(admin_id, None) is None:
+            return False
+        if not job.recipients:
+            job.state = "cancelled"
+            job.progress.cancelled = True
+            self._forget(job)
+        return True
+
+    def _forget(self, job: ExportJob) -> None:
+        self._jobs.pop(job.id, None)
+        if self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+
+    def start(self, bot: Bot, workers: int) -> list[asyncio.Task]:
+        return [asyncio.create_task(self._worker(bot)) for _ in range(workers)]
+
+    async def _worker(self, bot: Bot) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if not job.progress.cancelled:
+                    await self._run(bot, job)
+            except Exception:
+                logger.exception("Export job %s failed", job.id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, bot: Bot, job: ExportJob) -> None:
+        job.state = "running"
+        reporter = asyncio.create_task(self._report_progress(bot, job))
+        files: list[tuple[str, str, bool]] = []
+        # Временные файлы удаляются при любом исходе: сбой сборки, статуса или доставки
+        try:
+            try:
+                async with ReadSessionLocal() as session:
+                    files = await self._build(session, job)
+            except ExportCancelled:
+                return  # статус уже обновил отменивший
+            except Exception:
+                job.state = "failed"
+                raise
+            else:
+                job.state = "done"
+            finally:
+                reporter.cancel()
+                self._forget(job)
+                if job.state != "cancelled":
+                    await self._set_status(bot, job, None)
+
+            delivered = False
+            for chat_id, _ in list(job.recipients.values()):
+                try:
+                    for n, (path, filename, cached) in enumerate(files, start=1):
+                        caption = f"📥 {job.title}"
+                        if len(files) > 1:
+                            caption += f" (часть {n} из {len(files)})"
+                        await send_report(bot, chat_id, path, filename, caption, cached=cached)
+                    delivered = True
+                except TelegramAPIError:
+                    logger.exception("Failed to deliver export job %s to chat %s", job.id, chat_id)
+            if delivered and job.new_mark is not None:
+                # Отметка сдвигается только после доставки — иначе изменения потерялись бы
+                async with AsyncSessionLocal() as session:
+                    await ExportMarkRepo(session).advance(job.delta_for, job.new_mark)
+                    await session.commit()
+        finally:
+            for path, _, cached in files:
+                if not cached:
+                    os.remove(path)
+
+    async def _build(self, session: AsyncSession, job: ExportJob) -> list[tuple[str, str, bool]]:
+        """Собирает файлы задачи: [(путь, имя для пользователя, лежит ли в кэше отчётов)]."""
+        if job.delta_for is not None:
+            mark = await ExportMarkRepo(session).get(job.delta_for)
+            export = await build_delta_csv(
+                session,
+                mark.last_seq if mark else 0,
+                compress=job.kind == "csv.gz",
+                progress=job.progress,
+            )
+            if not export.rows:
+                for path in export.paths:
+                    os.remove(path)
+                job.note = "новых изменений нет"
+                return []
+            job.new_mark = export.last_seq
+            return self._csv_files(job, export.paths)
+
+        if job.kind == "xlsx":
+            path = await build_excel(session, job.months, job.progress)
+            if os.path.getsize(path) <= settings.export_part_max_bytes:
+                return [(path, f"{job.basename}.xlsx", True)]
+            # Excel не режется на части — слишком большой отчёт отдаём сжатым CSV
+            logger.info("Export job %s: xlsx exceeds the Telegram limit, falling back to csv.gz", job.id)
+            job.kind = "csv.gz"
+            job.progress.rows_fetched = 0
+        export = await build_csv(session, job.months, compress=job.kind == "csv.gz", progress=job.progress)
+        return self._csv_files(job, export.paths)
+
+    @staticmethod
+    def _csv_files(job: ExportJob, paths: list[str]) -> list[tuple[str, str, bool]]:
+        if len(paths) == 1:
+            return [(paths[0], f"{job.basename}.{job.kind}", False)]
+        return [
+            (path, f"{job.basename}.part{n}.{job.kind}", False)
+            for n, path in enumerate(paths, start=1)
+        ]
+
+    async def _report_progress(self, bot: Bot, job: ExportJob) -> None:
+        while True:
+            await asyncio.sleep(_PROGRESS_INTERVAL)
+            await self._set_status(bot, job, export_job_kb(job.id))
+
+    async def _set_status(self, bot: Bot, job: ExportJob, markup: InlineKeyboardMarkup | None) -> None:
+        text = job.status_text()
+        for chat_id, message_id in list(job.recipients.values()):
+            if message_id is None:
+                continue
+            try:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=markup)
+            except TelegramBadRequest:
+                pass  # текст не изменился или сообщение удалено
+            except TelegramAPIError:
+                # Сеть, RetryAfter, бот заблокирован — статус не главное, выгрузка продолжается
+                logger.warning(
+                    "Failed to update status of export job %s in chat %s", job.id, chat_id, exc_info=True
+                )
+
+
+export_jobs = ExportJobRunner(max_queued=settings.export_queue_size)
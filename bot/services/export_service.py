@@ -1,14 +1,27 @@
+import asyncio
+import contextlib
+import csv
+import gzip
+import hashlib
 import io
+import os
+import pickle
+import tempfile
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 
 from openpyxl import Workbook
-from openpyxl.styles import Alignment, Font, PatternFill
-from sqlalchemy.ext.asyncio import AsyncSession
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font, NamedStyle, PatternFill
+from openpyxl.utils import get_column_letter
+from sqlalchemy.ext.asyncio import AsyncResult, AsyncSession
 
-from bot.config import fmt_dt
-from bot.database.models import ROLE_LABELS, Record, User
+from bot.config import fmt_dt, settings
+from bot.database.models import ROLE_LABELS
 from bot.database.repositories.record_repo import RecordRepo
-from bot.database.repositories.user_repo import UserRepo
+from bot.services.report_cache import report_cache
 
 _HEADER_FILL = PatternFill("solid", fgColor="4472C4")
 _HEADER_FONT = Font(bold=True, color="FFFFFF", size=11)
@@ -17,83 +30,407 @@ _BOLD = Font(bold=True)
 _RETURN_FILL = PatternFill("solid", fgColor="FFD7D7")  # светло-красный для возвратов
 _COL_WIDTHS = [5, 35, 15, 15, 20, 20, 20, 12]
 _HEADERS = ["№", "ФИО", "Должность", "Telegram ID", "Номер договора", "Дата выдачи", "Дата возврата", "Статус"]
+_CSV_HEADERS = [
+    "id", "user_id", "full_name", "role", "site_number", "month",
+    "created_at_utc", "cancelled_at_utc", "is_cancelled",
+]
 
+# Именованные стили регистрируются в книге один раз; ячейки ссылаются на них по имени
+_HEADER_STYLE = "report_header"
+_RETURN_STYLE = "report_return"
+_TOTAL_STYLE = "report_total"
 
-def _write_sheet(ws, records: list[Record], user_map: dict[int, User], title: str) -> None:
-    ws.title = title[:31]
-
-    ws.append(_HEADERS)
-    for col_idx in range(1, len(_HEADERS) + 1):
-        cell = ws.cell(row=1, column=col_idx)
-        cell.font = _HEADER_FONT
-        cell.fill = _HEADER_FILL
-        cell.alignment = _HEADER_ALIGN
-
-    active_count = 0
-    returned_count = 0
-    for idx, record in enumerate(records, start=1):
-        user = user_map.get(record.user_id)
-        is_returned = record.is_cancelled
-        returned_at = fmt_dt(record.cancelled_at) if is_returned else ""
-        status = "Возврат" if is_returned else "Активна"
-        row = [
+# Форматы выгрузки: Excel-отчёт с листами по месяцам или плоский CSV всей таблицы records
+EXPORT_KINDS = ("xlsx", "csv", "csv.gz")
+
+# Увеличивать при любом изменении вида книги — старые файлы в кэше перестанут подходить
+_REPORT_FORMAT = 1
+
+
+def _add_styles(wb: Workbook) -> None:
+    wb.add_named_style(
+        NamedStyle(name=_HEADER_STYLE, font=_HEADER_FONT, fill=_HEADER_FILL, alignment=_HEADER_ALIGN)
+    )
+    wb.add_named_style(NamedStyle(name=_RETURN_STYLE, fill=_RETURN_FILL))
+    wb.add_named_style(NamedStyle(name=_TOTAL_STYLE, font=_BOLD))
+
+
+def _styled_row(ws, values: list, style: str) -> list[WriteOnlyCell]:
+    cells = []
+    for value in values:
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        cells.append(cell)
+    return cells
+
+
+# Строка отчёта, подготовленная в async-фазе: только простые типы, чтобы её можно
+# было передать в другой процесс. (user_id, ФИО, должность, номер договора,
+# дата выдачи, дата возврата, возврат?)
+ReportRow = tuple[int, str, str, str, datetime, datetime | None, bool]
+
+
+class ExportCancelled(Exception):
+    """Выгрузка отменена администратором."""
+
+
+class ExportProgress:
+    """
+    Ход выгрузки: обновляется фазами сборки, читается воркером для сообщения о статусе.
+    В пуле процессов render_excel получает None — там прогресс виден только до рендера,
+    а отмена срабатывает после него.
+    """
+
+    def __init__(self) -> None:
+        self.rows_fetched = 0
+        self.rows_written = 0
+        self.months_total = 0
+        self.months_done = 0
+        self.rendering = False
+        self.cancelled = False
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise ExportCancelled
+
+
+class _SheetWriter:
+    """Лист в write-only книге: строки пишутся сразу на диск, в памяти только счётчики."""
+
+    def __init__(self, wb: Workbook, title: str) -> None:
+        self.ws = wb.create_sheet(title=title[:31])
+        # В write-only режиме ширины колонок задаются до первой строки
+        for col_idx, width in enumerate(_COL_WIDTHS, start=1):
+            self.ws.column_dimensions[get_column_letter(col_idx)].width = width
+        self.ws.append(_styled_row(self.ws, _HEADERS, _HEADER_STYLE))
+        self.active_count = 0
+        self.returned_count = 0
+
+    def append(self, row: ReportRow) -> None:
+        user_id, full_name, role_label, site_number, created_at, cancelled_at, is_returned = row
+        idx = self.active_count + self.returned_count + 1
+        values = [
             idx,
-            user.full_name if user else f"ID:{record.user_id}",
-            ROLE_LABELS.get(user.role, user.role) if user else "—",
-            record.user_id,
-            record.site_number,
-            fmt_dt(record.created_at),
-            returned_at,
-            status,
+            full_name,
+            role_label,
+            user_id,
+            site_number,
+            fmt_dt(created_at),
+            fmt_dt(cancelled_at) if is_returned else "",
+            "Возврат" if is_returned else "Активна",
         ]
-        ws.append(row)
         if is_returned:
-            returned_count += 1
-            for col_idx in range(1, len(_HEADERS) + 1):
-                ws.cell(row=ws.max_row, column=col_idx).fill = _RETURN_FILL
+            self.returned_count += 1
+            self.ws.append(_styled_row(self.ws, values, _RETURN_STYLE))
+        else:
+            self.active_count += 1
+            self.ws.append(values)
+
+    def finish(self) -> None:
+        total = self.active_count + self.returned_count
+        summary = WriteOnlyCell(
+            self.ws,
+            value=f"Активных: {self.active_count}  |  Возвратов: {self.returned_count}  |  Всего: {total}",
+        )
+        summary.style = _TOTAL_STYLE
+        self.ws.append([])
+        self.ws.append(["", summary, "", "", "", "", "", ""])
+
+
+def _read_chunks(rows_path: str) -> Iterator[tuple[str, list[ReportRow]]]:
+    with open(rows_path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _discard(wb: Workbook) -> None:
+    """Закрывает листы брошенной write-only книги и удаляет их временные файлы openpyxl."""
+    for ws in wb.worksheets:
+        with contextlib.suppress(Exception):
+            ws.close()
+            ws._writer.cleanup()
+
+
+def render_excel(
+    rows_path: str, months: list[str], out_path: str, progress: ExportProgress | None = None
+) -> None:
+    """
+    Синхронная фаза выгрузки: читает подготовленные строки из rows_path
+    (порции (месяц, [ReportRow, ...]) в порядке месяцев) и пишет книгу в out_path.
+    Не обращается к БД и event loop, поэтому выполняется в пуле потоков или процессов.
+    """
+    wb = Workbook(write_only=True)
+    _add_styles(wb)
+
+    # Сводный лист если месяцев больше одного — создаётся первым, заполняется параллельно
+    summary = _SheetWriter(wb, "Сводная") if len(months) > 1 else None
+
+    chunks = _read_chunks(rows_path)
+    try:
+        pending = next(chunks, None)
+        for month in sorted(months):
+            dt = datetime.strptime(month, "%Y-%m")
+            sheet = _SheetWriter(wb, dt.strftime("%B %Y"))
+            while pending is not None and pending[0] == month:
+                for row in pending[1]:
+                    sheet.append(row)
+                    if summary is not None:
+                        summary.append(row)
+                if progress is not None:
+                    progress.rows_written += len(pending[1])
+                    progress.check()
+                pending = next(chunks, None)
+            sheet.finish()
+            if progress is not None:
+                progress.months_done += 1
+
+        if summary is not None:
+            summary.finish()
+    except BaseException:
+        _discard(wb)
+        raise
+    finally:
+        chunks.close()
+    wb.save(out_path)
+
+
+async def _fetch_rows(
+    session: AsyncSession, months: list[str], rows_path: str, progress: ExportProgress
+) -> None:
+    """
+    Async-фаза выгрузки: один запрос на весь период (с ФИО и ролью из users),
+    читается курсором; порции строк сбрасываются в rows_path по месяцам.
+    """
+    result = await RecordRepo(session).stream_report_rows(months)
+    with open(rows_path, "wb") as f:
+        async for partition in result.partitions():
+            # Порция может захватить границу месяцев — режем её, render_excel ждёт
+            # в каждой порции строки одного месяца
+            month: str | None = None
+            chunk: list[ReportRow] = []
+            for row in partition:
+                if row.month != month:
+                    if chunk:
+                        pickle.dump((month, chunk), f, protocol=pickle.HIGHEST_PROTOCOL)
+                    month, chunk = row.month, []
+                chunk.append((
+                    row.user_id,
+                    row.full_name if row.full_name is not None else f"ID:{row.user_id}",
+                    ROLE_LABELS.get(row.role, row.role) if row.role is not None else "—",
+                    row.site_number,
+                    row.created_at,
+                    row.cancelled_at,
+                    row.is_cancelled,
+                ))
+            if chunk:
+                pickle.dump((month, chunk), f, protocol=pickle.HIGHEST_PROTOCOL)
+            progress.rows_fetched += len(partition)
+            progress.check()
+
+
+_executor: Executor | None = None
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if settings.export_executor == "process":
+            _executor = ProcessPoolExecutor(max_workers=settings.export_workers)
         else:
-            active_count += 1
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.export_workers, thread_name_prefix="export"
+            )
+    return _executor
+
 
-    ws.append([])
-    ws.append(["", f"Активных: {active_count}  |  Возвратов: {returned_count}  |  Всего: {len(records)}", "", "", "", "", "", ""])
-    total_row = ws.max_row
-    ws.cell(row=total_row, column=2).font = _BOLD
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
 
-    for col_idx, width in enumerate(_COL_WIDTHS, start=1):
-        ws.column_dimensions[ws.cell(row=1, column=col_idx).column_letter].width = width
 
+def _temp_path(suffix: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="report_", suffix=suffix)
+    os.close(fd)
+    return path
 
-async def build_excel(session: AsyncSession, months: list[str]) -> bytes:
+
+def _cache_key(versions: dict[str, int]) -> str:
+    """Ключ кэша: набор месяцев с версиями их данных, формат книги и часовой пояс дат."""
+    parts = [f"v{_REPORT_FORMAT}", f"tz{settings.tz_offset}"]
+    parts += [f"{month}:{versions[month]}" for month in sorted(versions)]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+async def build_excel(
+    session: AsyncSession, months: list[str], progress: ExportProgress | None = None
+) -> str:
     """
     Генерирует Excel-отчёт за список месяцев.
     Один месяц — один лист. Несколько — лист на каждый + сводный лист.
     months формат: ["2026-02", "2026-01", ...]
+    session — read-only сессия (ReadSessionLocal), чтобы отчёт не занимал пул записи;
+    после выборки строк она закрывается, на время рендера соединение ей не нужно.
+
+    Данные выбираются здесь же, в event loop, а книга рендерится в пуле
+    (EXPORT_EXECUTOR / EXPORT_WORKERS). Готовый файл кладётся в report_cache
+    под ключом из версий месяцев, повторный запрос отдаёт его без генерации.
+    Возвращает путь к файлу в кэше — удалять его вызывающему не нужно.
+    Сколько сборок идёт одновременно, ограничивают воркеры export_jobs.
+    progress — ход сборки; при progress.cancelled бросается ExportCancelled.
+    """
+    progress = progress or ExportProgress()
+    progress.months_total = len(months)
+    # Версии читаются до строк: если запись добавят между запросами, файл попадёт
+    # в кэш под старой версией с более новыми данными — и просто не будет найден
+    versions = await RecordRepo(session).get_month_versions(months)
+    key = _cache_key(versions)
+    cached = report_cache.get(key, ".xlsx")
+    if cached is not None:
+        return cached
+
+    rows_path = _temp_path(".rows")
+    out_path = _temp_path(".xlsx")
+    try:
+        await _fetch_rows(session, months, rows_path, progress)
+        # Строки уже в rows_path — возвращаем соединение в пул read-only движка до рендера,
+        # иначе две выгрузки заняли бы весь пул и статистика ждала бы конца рендера
+        await session.close()
+        progress.rendering = True
+        # Объект прогресса можно разделить только с потоком: в процесс ушла бы его копия
+        render_progress = progress if settings.export_executor == "thread" else None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            _get_executor(), render_excel, rows_path, months, out_path, render_progress
+        )
+        progress.check()
+        return report_cache.put(key, ".xlsx", out_path)
+    except BaseException:
+        os.remove(out_path)
+        raise
+    finally:
+        os.remove(rows_path)
+
+
+class _CsvParts:
+    """
+    CSV-выгрузка частями: когда текущая часть доросла до max_bytes, открывается
+    следующая (со своей строкой заголовков), чтобы каждая помещалась в лимит Telegram.
+    Для gzip размер — сжатые байты, уже записанные на диск (без сброса компрессора,
+    чтобы не портить степень сжатия), поэтому отстаёт на десятки КБ — запас в лимите есть.
+    """
+
+    def __init__(self, compress: bool, max_bytes: int) -> None:
+        self._compress = compress
+        self._max_bytes = max_bytes
+        self.paths: list[str] = []
+        self._open()
+
+    def _open(self) -> None:
+        path = _temp_path(".csv.gz" if self._compress else ".csv")
+        self.paths.append(path)
+        self._raw = open(path, "wb")
+        stream = gzip.GzipFile(fileobj=self._raw, mode="wb") if self._compress else self._raw
+        self._text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(_CSV_HEADERS)
+
+    def _size(self) -> int:
+        if not self._compress:
+            self._text.flush()
+        return self._raw.tell()
+
+    def write_rows(self, rows: Iterable[tuple]) -> None:
+        if self._size() >= self._max_bytes:
+            self.close()
+            self._open()
+        self._writer.writerows(rows)
+
+    def close(self) -> None:
+        self._text.close()  # GzipFile дописывает трейлер, но fileobj не закрывает
+        self._raw.close()
+
+
+def _iso(value: datetime | None) -> str:
+    return value.isoformat(sep=" ") if value is not None else ""
+
+
+@dataclass
+class CsvExport:
+    """Результат CSV-выгрузки: временные файлы частей и наибольший выгруженный changed_seq."""
+
+    paths: list[str] = field(default_factory=list)
+    rows: int = 0
+    last_seq: int = 0
+
+
+async def _write_csv(result: AsyncResult, compress: bool, progress: ExportProgress) -> CsvExport:
+    export = CsvExport()
+    parts = _CsvParts(compress, settings.export_part_max_bytes)
+    export.paths = parts.paths
+    try:
+        async for partition in result.partitions():
+            parts.write_rows(
+                (
+                    row.id,
+                    row.user_id,
+                    row.full_name or "",
+                    row.role or "",
+                    row.site_number,
+                    row.month,
+                    _iso(row.created_at),
+                    _iso(row.cancelled_at),
+                    int(row.is_cancelled),
+                )
+                for row in partition
+            )
+            export.last_seq = max(export.last_seq, *(row.changed_seq for row in partition))
+            export.rows += len(partition)
+            progress.rows_fetched += len(partition)
+            progress.check()
+        parts.close()
+    except BaseException:
+        parts.close()
+        for path in parts.paths:
+            os.remove(path)
+        raise
+    return export
+
+
+async def build_csv(
+    session: AsyncSession, months: list[str], compress: bool, progress: ExportProgress | None = None
+) -> CsvExport:
+    """
+    Полная выгрузка records за месяцы в CSV (для бухгалтерии): строки идут курсором
+    прямо в файл, память постоянна. Даты — UTC в ISO-формате, роль — код.
+    Больше EXPORT_PART_MAX_BYTES режется на части; пути частей — временные файлы,
+    удалить их после отправки должен вызывающий.
     """
-    record_repo = RecordRepo(session)
-    user_repo = UserRepo(session)
-
-    users: list[User] = await user_repo.get_all()
-    user_map: dict[int, User] = {u.telegram_id: u for u in users}
-
-    wb = Workbook()
-    wb.remove(wb.active)  # удаляем пустой лист по умолчанию
-
-    all_records: list[Record] = []
-
-    for month in sorted(months):
-        records = await record_repo.get_by_month_all_users_full(month)
-        all_records.extend(records)
-        dt = datetime.strptime(month, "%Y-%m")
-        sheet_title = dt.strftime("%B %Y")
-        ws = wb.create_sheet(title=sheet_title)
-        _write_sheet(ws, records, user_map, sheet_title)
-
-    # Сводный лист если месяцев больше одного
-    if len(months) > 1:
-        ws_summary = wb.create_sheet(title="Сводная", index=0)
-        _write_sheet(ws_summary, all_records, user_map, "Сводная")
-
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf.read()
+    progress = progress or ExportProgress()
+    progress.months_total = len(months)
+    result = await RecordRepo(session).stream_report_rows(months)
+    return await _write_csv(result, compress, progress)
+
+
+async def build_delta_csv(
+    session: AsyncSession,
+    after_seq: int,
+    compress: bool,
+    progress: ExportProgress | None = None,
+) -> CsvExport:
+    """
+    Дельта-выгрузка: только записи, выданные или возвращённые после отметки
+    прошлой выгрузки (changed_seq), в том же формате, что build_csv.
+    Новая отметка — export.last_seq.
+    """
+    result = await RecordRepo(session).stream_changed_rows(after_seq)
+    return await _write_csv(result, compress, progress or ExportProgress())
+
+
+def report_key(months: list[str], kind: str) -> tuple[str, tuple[str, ...]]:
+    """Ключ отчёта для дедупликации выгрузок: вид отчёта и набор месяцев без учёта порядка."""
+    return kind, tuple(sorted(set(months)))
@@ -1,17 +1,18 @@
 from dataclasses import dataclass
 
-from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from bot.database.cache import UserSnapshot
 from bot.database.models import Record, User
 from bot.database.repositories.quota_repo import QuotaRepo
-from bot.database.repositories.record_repo import RecordRepo
+from bot.database.repositories.record_repo import RecordRepo, _current_month
 
 
 @dataclass
 class QuotaStatus:
     used: int
     limit: int
+    is_personal: bool = False  # лимит задан персонально, а не по роли
 
     @property
     def remaining(self) -> int:
@@ -22,41 +23,76 @@ class QuotaStatus:
         return self.remaining > 0
 
 
+@dataclass
+class CabinetSnapshot:
+    status: QuotaStatus
+    total: int  # всего активных записей за всё время
+    history: list[Record]  # первая страница истории, новые первые
+
+
 class QuotaService:
     def __init__(self, session: AsyncSession) -> None:
         self._quota_repo = QuotaRepo(session)
         self._record_repo = RecordRepo(session)
 
-    async def get_status(self, user: User) -> QuotaStatus:
-        return await self.get_status_for(user.telegram_id, user.role)
+    async def get_cabinet(self, user: UserSnapshot, history_limit: int = 0) -> CabinetSnapshot:
+        """
+        Всё для экрана кабинета за один запрос к БД: использовано, всего записей
+        и первая страница истории. Лимит берётся из кэша квот.
+        history_limit=0 — только квота, без истории.
+        """
+        limit = await self._quota_repo.get_limit(user.telegram_id, user.role)
+        used, total, history = await self._record_repo.get_usage_with_history(
+            user.telegram_id, history_limit
+        )
+        return CabinetSnapshot(
+            status=QuotaStatus(used=used, limit=limit),
+            total=total,
+            history=history,
+        )
+
+    async def get_status(self, user: UserSnapshot) -> QuotaStatus:
+        """Только квота: один поиск счётчика по первичному ключу."""
+        return (await self.get_cabinet(user)).status
 
-    async def get_status_for(self, user_id: int, user_role: str) -> QuotaStatus:
-        limit = await self._quota_repo.get_limit(user_id, user_role)
-        used = await self._record_repo.count_used(user_id)
-        return QuotaStatus(used=used, limit=limit)
+    async def get_status_many(
+        self, user_ids: list[int], month: str | None = None
+    ) -> dict[int, QuotaStatus]:
+        """Квоты сразу для многих сотрудников: один запрос с JOIN на quotas и счётчики."""
+        rows = await self._quota_repo.get_statuses(user_ids, month or _current_month())
+        return {
+            user.telegram_id: QuotaStatus(used=used, limit=limit, is_personal=personal is not None)
+            for user, used, limit, personal in rows
+        }
 
-    async def take(self, user: User, site_number: str) -> Record | None:
+    async def get_near_limit(
+        self, threshold: int = 1, month: str | None = None
+    ) -> list[tuple[User, QuotaStatus]]:
+        """Сотрудники, у которых осталось не больше threshold единиц квоты."""
+        rows = await self._quota_repo.get_near_limit(month or _current_month(), threshold)
+        return [
+            (user, QuotaStatus(used=used, limit=limit, is_personal=personal is not None))
+            for user, used, limit, personal in rows
+        ]
+
+    async def take(self, user: UserSnapshot, site_number: str) -> Record | None:
         """
         Списывает 1 единицу квоты.
         Возвращает созданную запись или None если квота исчерпана.
-        rollback() завершает lazy-транзакцию SQLAlchemy, после чего
-        BEGIN IMMEDIATE сериализует конкурентные запросы в SQLite,
-        исключая race condition при двойном нажатии.
-        Значения user извлекаются до rollback(), т.к. после него
-        ORM-объект становится expired и недоступен без новой сессии.
+        Лимит (персональный → по роли → по умолчанию) и количество
+        использованных считаются внутри одного INSERT ... SELECT ... WHERE,
+        поэтому двойное нажатие не может выдать больше квоты.
+        rollback() завершает lazy-транзакцию SQLAlchemy, чтобы INSERT
+        открыл новую транзакцию и сразу взял блокировку записи.
         """
         user_id = user.telegram_id
         user_role = user.role
         session = self._record_repo._session
         await session.rollback()
-        await session.execute(text("BEGIN IMMEDIATE"))
-        limit = await self._quota_repo.get_limit(user_id, user_role)
-        used = await self._record_repo.count_used(user_id)
-        if used >= limit:
-            return None
-        return await self._record_repo.create(user_id, site_number)
+        limit = QuotaRepo.limit_expr(user_id, user_role)
+        return await self._record_repo.create_within_limit(user_id, site_number, limit)
 
-    async def return_own(self, user: User, site_number: str) -> Record | None:
+    async def return_own(self, user: UserSnapshot, site_number: str) -> Record | None:
         """
         Сотрудник возвращает свою дровницу за текущий месяц.
         Возвращает отменённую запись или None если не найдена.
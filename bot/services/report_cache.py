@@ -0,0 +1,102 @@
+import os
+import shutil
+
+from bot.config import settings
+from bot.database.cache import LruTtlCache
+
+
+class ReportCache:
+    """
+    Готовые файлы отчётов на диске: <key><suffix> в одном каталоге.
+    Ключ включает версии данных всех месяцев отчёта, поэтому устаревшие файлы
+    не инвалидируются явно — на них просто перестают ссылаться, и их вытесняет LRU.
+    Время последнего обращения — mtime файла, общий размер ограничен max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self._dir, key + suffix)
+
+    def get(self, key: str, suffix: str) -> str | None:
+        path = self._path(key, suffix)
+        try:
+            os.utime(path)  # отмечаем обращение для LRU
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key: str, suffix: str, src_path: str) -> str:
+        """Переносит готовый файл в кэш и вытесняет старые. Возвращает путь в кэше."""
+        os.makedirs(self._dir, exist_ok=True)
+        path = self._path(key, suffix)
+        # os.replace атомарен только в пределах одной ФС — tmp может быть на другой
+        tmp_path = path + ".tmp"
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+        return path
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        try:
+            names = os.listdir(self._dir)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(self._dir, name)
+            if name.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self, keep: str) -> None:
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self._max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> int:
+        """Удаляет все файлы кэша. Возвращает их количество."""
+        removed = 0
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def stats(self) -> dict[str, int]:
+        entries = self._entries()
+        return {
+            "size": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+report_cache = ReportCache(settings.report_cache_dir, settings.report_cache_max_bytes)
+
+# (имя файла в кэше, имя файла для пользователя) → file_id уже загруженного в Telegram документа.
+# Имя в кэше — хэш версий данных, т.е. одинаковое имя = одинаковое содержимое отчёта
+report_file_ids = LruTtlCache(maxsize=256, ttl=24 * 3600)
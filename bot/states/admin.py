@@ -21,3 +21,11 @@ class BroadcastStates(StatesGroup):
     choose_user = State()     # если конкретному — пагинированный выбор
     waiting_text = State()    # текст сообщения
     confirm = State()         # подтверждение перед отправкой
+
+
+class AdminSearchStates(StatesGroup):
+    waiting_query = State()   # ФИО, телефон или № договора
+
+
+class UserSearchStates(StatesGroup):
+    waiting_query = State()   # начало ФИО для списка выбора сотрудника
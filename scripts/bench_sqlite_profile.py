@@ -0,0 +1,272 @@
+"""
+Нагрузочное сравнение профилей PRAGMA SQLite: DELETE/FULL (как до профиля в настройках)
+против профиля по умолчанию из bot.config (WAL/NORMAL, кэш, mmap).
+
+Писатели берут и возвращают квоту через QuotaService, читатели листают статистику,
+историю и выгрузку месяца через read-only движок — те же запросы, что у бота.
+Каждый профиль запускается в отдельном процессе: настройки читаются при импорте bot.
+
+    python -m scripts.bench_sqlite_profile --writers 4 --readers 4 --seconds 10
+
+База создаётся во временном каталоге внутри --dir (по умолчанию data/ — тот же диск,
+что у рабочей БД). На tmpfs fsync почти бесплатен, и разница FULL/NORMAL не видна.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+_ROOT = Path(__file__).resolve().parent.parent
+_RESULT_PREFIX = "BENCH_RESULT "
+_USER_ID_BASE = 10_000
+_MONTHS = 6
+_READ_PAGE = 30
+
+# Профиль → переменные окружения PRAGMA; не заданные здесь берутся из значений по умолчанию Settings
+_PROFILES: dict[str, dict[str, str]] = {
+    "DELETE/FULL": {
+        "SQLITE_JOURNAL_MODE": "DELETE",
+        "SQLITE_SYNCHRONOUS": "FULL",
+        "SQLITE_CACHE_SIZE": "-2000",
+        "SQLITE_MMAP_SIZE": "0",
+        "SQLITE_TEMP_STORE": "DEFAULT",
+    },
+    "WAL (настройки)": {},
+}
+_PROFILE_FIELDS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store")
+
+
+def _profile_env(name: str) -> dict[str, str]:
+    from bot.config import Settings
+
+    env = {
+        f"SQLITE_{field.upper()}": str(Settings.model_fields[f"sqlite_{field}"].default)
+        for field in _PROFILE_FIELDS
+    }
+    env.update(_PROFILES[name])
+    return env
+
+
+def _months() -> list[str]:
+    """Текущий месяц и _MONTHS - 1 предыдущих, от старых к новым."""
+    year, month = datetime.now(timezone.utc).year, datetime.now(timezone.utc).month
+    result = []
+    for _ in range(_MONTHS):
+        result.append(f"{year:04d}-{month:02d}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return result[::-1]
+
+
+def _percentile(latencies: list[float], q: float) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+
+
+# ---------------------------------------------------------------------------
+# Дочерний процесс: один профиль
+# ---------------------------------------------------------------------------
+
+
+async def _prepare(users: int, records: int) -> list:
+    """Пустая БД, сотрудники с большим персональным лимитом и records записей за _MONTHS месяцев."""
+    from sqlalchemy import insert, text
+
+    from bot.database.base import AsyncSessionLocal, init_db
+    from bot.database.models import ROLES, Record
+    from bot.database.repositories.quota_repo import QuotaRepo
+    from bot.database.repositories.record_repo import RecordRepo
+    from bot.database.repositories.user_repo import UserRepo
+
+    await init_db()
+    months = _months()
+    user_ids = range(_USER_ID_BASE, _USER_ID_BASE + users)
+    async with AsyncSessionLocal() as session:
+        quota_repo = QuotaRepo(session)
+        await quota_repo.seed_defaults()
+        user_repo = UserRepo(session)
+        for telegram_id in user_ids:
+            await user_repo.create(telegram_id, f"Сотрудник {telegram_id}", "+79000000000", ROLES[0])
+            await quota_repo.set_personal_limit(telegram_id, 1_000_000)
+        start = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=30 * _MONTHS)
+        rows = [
+            {
+                "user_id": _USER_ID_BASE + n % users,
+                "site_number": f"{n}/1",
+                "created_at": start + timedelta(minutes=n),
+                "month": months[n * _MONTHS // records],
+                "is_cancelled": n % 10 == 0,
+                "cancelled_at": start + timedelta(minutes=n + 1) if n % 10 == 0 else None,
+            }
+            for n in range(records)
+        ]
+        if rows:
+            await session.execute(insert(Record), rows)
+        await RecordRepo(session).rebuild_rollups()
+        await session.commit()
+        await session.execute(text("ANALYZE"))
+        await session.commit()
+        await quota_repo.load_cache()
+        return [await user_repo.get_snapshot(telegram_id) for telegram_id in user_ids]
+
+
+async def _writer(number: int, users: list, deadline: float, latencies: list[float], errors: list[str]) -> None:
+    """Берёт дровницу, каждую пятую — сразу возвращает."""
+    from bot.database.base import AsyncSessionLocal
+    from bot.services.quota_service import QuotaService
+
+    n = 0
+    while time.perf_counter() < deadline:
+        user = random.choice(users)
+        site_number = f"w{number}/{n}"
+        started = time.perf_counter()
+        try:
+            async with AsyncSessionLocal() as session:
+                service = QuotaService(session)
+                await service.take(user, site_number)
+                if n % 5 == 4:
+                    await service.return_own(user, site_number)
+                await session.commit()
+        except Exception as exc:  # noqa: BLE001 — считаем, а не падаем: «database is locked» тоже результат
+            errors.append(type(exc).__name__)
+        else:
+            latencies.append(time.perf_counter() - started)
+        n += 1
+
+
+async def _reader(users: list, deadline: float, latencies: list[float], errors: list[str]) -> None:
+    """По кругу: страница статистики, страница истории, выгрузка текущего месяца целиком."""
+    from bot.database.base import ReadSessionLocal
+    from bot.database.repositories.record_repo import RecordRepo
+    from bot.database.repositories.stats_repo import StatsRepo
+
+    months = _months()
+    n = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            async with ReadSessionLocal() as session:
+                if n % 3 == 0:
+                    await StatsRepo(session).users_page(months[-3:], 0, 10)
+                elif n % 3 == 1:
+                    await RecordRepo(session).get_history(random.choice(users).telegram_id, _READ_PAGE)
+                else:
+                    result = await RecordRepo(session).stream_report_rows(months[-1:])
+                    async for _partition in result.partitions():
+                        pass
+        except Exception as exc:  # noqa: BLE001
+            errors.append(type(exc).__name__)
+        else:
+            latencies.append(time.perf_counter() - started)
+        n += 1
+
+
+async def _run_profile(args: argparse.Namespace) -> dict:
+    from bot.database.base import engine, get_pragma_report, read_engine
+
+    users = await _prepare(args.users, args.records)
+    pragmas = await get_pragma_report()
+    write_latencies: list[float] = []
+    read_latencies: list[float] = []
+    errors: list[str] = []
+    deadline = time.perf_counter() + args.seconds
+    await asyncio.gather(
+        *(_writer(n, users, deadline, write_latencies, errors) for n in range(args.writers)),
+        *(_reader(users, deadline, read_latencies, errors) for _ in range(args.readers)),
+    )
+    await engine.dispose()
+    await read_engine.dispose()
+    return {
+        "pragmas": pragmas,
+        "writes": len(write_latencies),
+        "reads": len(read_latencies),
+        "write_p50": _percentile(write_latencies, 0.5),
+        "write_p95": _percentile(write_latencies, 0.95),
+        "read_p50": _percentile(read_latencies, 0.5),
+        "read_p95": _percentile(read_latencies, 0.95),
+        "errors": errors,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Родительский процесс: запуск профилей и сводка
+# ---------------------------------------------------------------------------
+
+
+def _spawn(profile: str, args: argparse.Namespace, db_dir: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "123456:bench")
+    env.setdefault("ADMIN_IDS", "1")
+    env.update(_profile_env(profile))
+    env["DB_PATH"] = os.path.join(db_dir, "bench.db")
+    command = [
+        sys.executable, "-m", "scripts.bench_sqlite_profile", "--child",
+        "--users", str(args.users), "--records", str(args.records),
+        "--writers", str(args.writers), "--readers", str(args.readers),
+        "--seconds", str(args.seconds),
+    ]
+    completed = subprocess.run(command, cwd=_ROOT, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        sys.stderr.write(completed.stderr)
+        raise SystemExit(f"профиль {profile}: процесс завершился с кодом {completed.returncode}")
+    line = next(
+        line for line in reversed(completed.stdout.splitlines()) if line.startswith(_RESULT_PREFIX)
+    )
+    return json.loads(line[len(_RESULT_PREFIX):])
+
+
+def _print_report(results: dict[str, dict], seconds: float) -> None:
+    print(f"{'профиль':<18}{'запись/с':>10}{'p50, мс':>9}{'p95, мс':>9}"
+          f"{'чтение/с':>10}{'p50, мс':>9}{'p95, мс':>9}{'ошибок':>8}")
+    for profile, r in results.items():
+        print(
+            f"{profile:<18}{r['writes'] / seconds:>10.1f}{r['write_p50']:>9.1f}{r['write_p95']:>9.1f}"
+            f"{r['reads'] / seconds:>10.1f}{r['read_p50']:>9.1f}{r['read_p95']:>9.1f}{len(r['errors']):>8}"
+        )
+    for profile, r in results.items():
+        pragmas = ", ".join(f"{name}={value}" for name, value in r["pragmas"].items())
+        print(f"\n{profile}: {pragmas}")
+        if r["errors"]:
+            print(f"  ошибки: {', '.join(sorted(set(r['errors'])))}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--records", type=int, default=20_000, help="записей в БД до начала замера")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10.0, help="длительность замера каждого профиля")
+    parser.add_argument("--dir", default="data", help="где создать временную БД")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = asyncio.run(_run_profile(args))
+        print(_RESULT_PREFIX + json.dumps(result, ensure_ascii=False), flush=True)
+        return
+
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("ADMIN_IDS", "1")
+    os.makedirs(args.dir, exist_ok=True)
+    results = {}
+    for profile in _PROFILES:
+        db_dir = tempfile.mkdtemp(prefix="bench_", dir=os.path.abspath(args.dir))
+        try:
+            results[profile] = _spawn(profile, args, db_dir)
+        finally:
+            shutil.rmtree(db_dir, ignore_errors=True)
+    _print_report(results, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
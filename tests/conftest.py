@@ -0,0 +1,55 @@
+import asyncio
+import os
+import tempfile
+
+# Настройки читаются при импорте bot.config — окружение задаём до импорта пакета
+_TMP_DIR = tempfile.mkdtemp(prefix="quota_bot_tests_")
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("ADMIN_IDS", "1")
+os.environ["DB_PATH"] = os.path.join(_TMP_DIR, "test.db")
+
+import pytest  # noqa: E402
+
+from bot.config import settings  # noqa: E402
+from bot.database import base  # noqa: E402
+from bot.database.cache import user_cache, user_count_cache  # noqa: E402
+from bot.database.repositories.quota_repo import QuotaRepo  # noqa: E402
+
+
+def _remove_db() -> None:
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(settings.db_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+@pytest.fixture
+def run():
+    """
+    Запускает сценарий (async-функцию без аргументов) на чистой БД — как при старте бота:
+    init_db, квоты по умолчанию, кэш лимитов. После сценария пулы соединений закрываются:
+    у каждого теста свой event loop.
+    """
+    _remove_db()
+    user_cache.clear()
+    user_count_cache.clear()
+
+    def runner(scenario):
+        async def main():
+            try:
+                await base.init_db()
+                async with base.AsyncSessionLocal() as session:
+                    repo = QuotaRepo(session)
+                    await repo.seed_defaults()
+                    await session.commit()
+                    await repo.load_cache()
+                return await scenario()
+            finally:
+                await base.engine.dispose()
+                await base.read_engine.dispose()
+
+        return asyncio.run(main())
+
+    yield runner
+    _remove_db()
@@ -0,0 +1,88 @@
+from sqlalchemy import insert
+
+from bot.database.base import AsyncSessionLocal, ReadSessionLocal
+from bot.database.models import ROLES, Record
+from bot.database.repositories.export_mark_repo import ExportMarkRepo
+from bot.database.repositories.record_repo import RecordRepo, _current_month, next_change_seq
+from bot.database.repositories.user_repo import UserRepo
+
+_USER_ID = 100
+_ADMIN_ID = 1
+
+
+async def _register() -> None:
+    async with AsyncSessionLocal() as session:
+        await UserRepo(session).create(_USER_ID, "Сотрудник", "+79000000000", ROLES[0])
+        await session.commit()
+
+
+async def _take(site_number: str) -> Record:
+    async with AsyncSessionLocal() as session:
+        record = await RecordRepo(session).create_within_limit(_USER_ID, site_number, 100)
+        await session.commit()
+        return record
+
+
+async def _delta(after_seq: int) -> tuple[list[str], int]:
+    """(номера договоров в дельте, новая отметка) — как их читает воркер выгрузок."""
+    async with ReadSessionLocal() as session:
+        result = await RecordRepo(session).stream_changed_rows(after_seq)
+        rows = [row async for row in result]
+    return [row.site_number for row in rows], max((row.changed_seq for row in rows), default=after_seq)
+
+
+def test_delta_keeps_rows_committed_after_export(run):
+    async def scenario():
+        await _register()
+        await _take("12/1")
+        # Выдача уже выполнила INSERT, но ещё не зафиксирована, когда идёт выгрузка
+        async with AsyncSessionLocal() as pending:
+            await RecordRepo(pending).create_within_limit(_USER_ID, "12/2", 100)
+            first, mark = await _delta(0)
+            await pending.commit()
+        await _take("12/3")
+        second, mark = await _delta(mark)
+        third, _ = await _delta(mark)
+        return first, second, third
+
+    first, second, third = run(scenario)
+    assert first == ["12/1"]
+    assert second == ["12/2", "12/3"]
+    assert third == []
+
+
+def test_return_enters_next_delta_once(run):
+    async def scenario():
+        await _register()
+        old = await _take("12/1")
+        await _take("12/2")
+        # Возврат из старой БД — без даты; выгружается один раз, как и любая запись
+        async with AsyncSessionLocal() as session:
+            await session.execute(insert(Record).values(
+                user_id=_USER_ID, site_number="12/0", month=_current_month(),
+                is_cancelled=True, cancelled_at=None, changed_seq=next_change_seq(),
+            ))
+            await session.commit()
+        _, mark = await _delta(0)
+        async with AsyncSessionLocal() as session:
+            await RecordRepo(session).cancel(old.id)
+            await session.commit()
+        second, mark = await _delta(mark)
+        third, _ = await _delta(mark)
+        return second, third
+
+    second, third = run(scenario)
+    assert second == ["12/1"]
+    assert third == []
+
+
+def test_export_mark_only_moves_forward(run):
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            repo = ExportMarkRepo(session)
+            await repo.advance(_ADMIN_ID, 10)
+            await repo.advance(_ADMIN_ID, 5)
+            await session.commit()
+            return (await repo.get(_ADMIN_ID)).last_seq
+
+    assert run(scenario) == 10
@@ -0,0 +1,37 @@
+from bot.database import base
+from bot.database.base import AsyncSessionLocal, ReadSessionLocal
+from bot.database.models import ROLES
+from bot.database.repositories.record_repo import RecordRepo, _current_month
+from bot.database.repositories.user_repo import UserRepo
+from bot.services import export_service
+from bot.services.export_service import build_excel
+
+
+async def _seed_records(count: int) -> None:
+    async with AsyncSessionLocal() as session:
+        await UserRepo(session).create(100, "Сотрудник", "+79000000000", ROLES[0])
+        records = RecordRepo(session)
+        for n in range(count):
+            await records.create(100, f"12/{n}")
+        await session.commit()
+
+
+def test_excel_render_does_not_hold_read_connection(run, monkeypatch):
+    """Пока книга рендерится в пуле, соединение read-only движка свободно для статистики."""
+    render = export_service.render_excel
+    checked_out: list[int] = []
+
+    def render_excel(*args):
+        checked_out.append(base.read_engine.pool.checkedout())
+        render(*args)
+
+    monkeypatch.setattr(export_service, "render_excel", render_excel)
+
+    async def scenario():
+        await _seed_records(5)
+        async with ReadSessionLocal() as session:
+            return await build_excel(session, [_current_month()])
+
+    path = run(scenario)
+    assert path.endswith(".xlsx")
+    assert checked_out == [0]
@@ -0,0 +1,153 @@
+import re
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, insert, text
+from sqlalchemy.ext.asyncio import AsyncResult, AsyncSession
+
+from bot.database import base
+from bot.database.base import AsyncSessionLocal
+from bot.database.models import ROLES, Record
+from bot.database.repositories.record_repo import RecordRepo
+from bot.database.repositories.search_repo import SearchRepo
+from bot.database.repositories.stats_repo import StatsRepo
+from bot.database.repositories.user_repo import UserRepo
+
+_USERS = 40
+_MONTHS = ["2026-01", "2026-02", "2026-03", "2026-04", "2026-05", "2026-06"]
+_PER_MONTH = 10
+_USER_ID = 1005
+_MONTH = "2026-04"
+_AFTER_SEQ = 2000
+_CURSOR = (datetime(2026, 5, 1), 1000)
+
+# Полный проход по records, т.е. строка плана «SCAN records ...»; records_fts — другая таблица
+_SCAN_RECORDS = re.compile(r"\bSCAN records(_\d+)?\b")
+
+_CASES = {
+    "count_used": lambda records, stats: records.count_used(_USER_ID, _MONTH),
+    "bump_month_versions": lambda records, stats: records.bump_month_versions([_MONTH]),
+    "get_month_versions": lambda records, stats: records.get_month_versions(_MONTHS),
+    "get_user_months": lambda records, stats: records.get_user_months(_USER_ID),
+    "create": lambda records, stats: records.create(_USER_ID, "новый"),
+    "create_within_limit": lambda records, stats: records.create_within_limit(_USER_ID, "новый", 100),
+    "find_active": lambda records, stats: records.find_active(_USER_ID, "4-1005-3", _MONTH),
+    "find_active_any_user": lambda records, stats: records.find_active_any_user("4-1005-3", _MONTH),
+    "cancel": lambda records, stats: records.cancel(1),
+    "get_cancelled_records": lambda records, stats: records.get_cancelled_records(limit=10),
+    "get_cancelled_records_months": lambda records, stats: records.get_cancelled_records([_MONTH], 10),
+    "get_cancelled_records_after": lambda records, stats: records.get_cancelled_records(limit=10, after=_CURSOR),
+    "get_cancelled_records_before": lambda records, stats: records.get_cancelled_records(limit=10, before=_CURSOR),
+    "count_cancelled_records": lambda records, stats: records.count_cancelled_records([_MONTH]),
+    "get_history": lambda records, stats: records.get_history(_USER_ID, 10),
+    "get_history_after": lambda records, stats: records.get_history(_USER_ID, 10, after=_CURSOR),
+    "get_history_before": lambda records, stats: records.get_history(_USER_ID, 10, before=_CURSOR),
+    "get_usage_with_history": lambda records, stats: records.get_usage_with_history(_USER_ID, 10),
+    "count_history": lambda records, stats: records.count_history(_USER_ID),
+    "stream_report_rows": lambda records, stats: records.stream_report_rows([_MONTH]),
+    "stream_changed_rows": lambda records, stats: records.stream_changed_rows(_AFTER_SEQ),
+    "stream_changed_rows_all": lambda records, stats: records.stream_changed_rows(0),
+    "get_stats_months": lambda records, stats: records.get_stats_months(),
+    "period_totals": lambda records, stats: stats.period_totals(_MONTHS[:3]),
+    "count_users": lambda records, stats: stats.count_users(_MONTHS[:3]),
+    "users_page": lambda records, stats: stats.users_page(_MONTHS[:3], 0, 10),
+    "user_stats": lambda records, stats: stats.user_stats(_USER_ID, _MONTHS[:3]),
+    "user_contracts": lambda records, stats: stats.user_contracts(_USER_ID, _MONTHS[:3], 0, 25),
+}
+
+# Методы, которым полный проход по records нужен по смыслу. Проверяется, что он есть:
+# иначе метод стал дешевле и его место в _CASES
+_FULL_SCAN_CASES = {
+    # пересчитывает итоги по всей таблице
+    "rebuild_rollups": lambda records, stats: records.rebuild_rollups(),
+}
+
+
+async def _populate() -> None:
+    """Несколько тысяч записей: сотрудники × месяцы, каждая пятая — возврат. Затем ANALYZE."""
+    async with AsyncSessionLocal() as session:
+        user_repo = UserRepo(session)
+        for telegram_id in range(1000, 1000 + _USERS):
+            await user_repo.create(telegram_id, f"Сотрудник {telegram_id}", "+79000000000", ROLES[0])
+        rows = []
+        for month_index, month in enumerate(_MONTHS, start=1):
+            start = datetime(2026, month_index, 1)
+            for telegram_id in range(1000, 1000 + _USERS):
+                for n in range(_PER_MONTH):
+                    created_at = start + timedelta(hours=n, minutes=telegram_id % 60)
+                    cancelled = n % 5 == 0
+                    rows.append({
+                        "user_id": telegram_id,
+                        "site_number": f"{month_index}-{telegram_id}-{n}",
+                        "created_at": created_at,
+                        "month": month,
+                        "is_cancelled": cancelled,
+                        "cancelled_at": created_at + timedelta(days=1) if cancelled else None,
+                        "changed_seq": len(rows) + 1,
+                    })
+        await session.execute(insert(Record), rows)
+        await RecordRepo(session).rebuild_rollups()
+        await session.commit()
+        await session.execute(text("ANALYZE"))
+        await session.commit()
+
+
+async def _plans(call: Callable[[AsyncSession], Awaitable]) -> list[str]:
+    """Строки EXPLAIN QUERY PLAN для каждого запроса, который выполнил call(session)."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith("EXPLAIN"):
+            statements.append((statement, parameters))
+
+    event.listen(base.engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        async with AsyncSessionLocal() as session:
+            result = await call(session)
+            if isinstance(result, AsyncResult):
+                await result.close()
+            plans = []
+            for statement, parameters in statements:
+                plan = await (await session.connection()).exec_driver_sql(
+                    "EXPLAIN QUERY PLAN " + statement, parameters
+                )
+                # У DELETE без WHERE плана нет — SQLite не возвращает ни одной строки
+                if plan.returns_rows:
+                    plans.extend(f"{row[3]}  <- {statement.split()[0]}" for row in plan.all())
+            await session.rollback()
+    finally:
+        event.remove(base.engine.sync_engine, "before_cursor_execute", capture)
+    assert statements, "не выполнено ни одного запроса"
+    return plans
+
+
+def _case_plans(run, case) -> list[str]:
+    async def scenario():
+        await _populate()
+        return await _plans(lambda session: case(RecordRepo(session), StatsRepo(session)))
+
+    return run(scenario)
+
+
+@pytest.mark.parametrize("name", list(_CASES))
+def test_no_full_scan_of_records(run, name):
+    plans = _case_plans(run, _CASES[name])
+    assert not any(_SCAN_RECORDS.search(line) for line in plans), (
+        f"{name}: полный проход по records\n" + "\n".join(plans)
+    )
+
+
+@pytest.mark.parametrize("name", list(_FULL_SCAN_CASES))
+def test_full_scan_where_expected(run, name):
+    plans = _case_plans(run, _FULL_SCAN_CASES[name])
+    assert any(_SCAN_RECORDS.search(line) for line in plans), "\n".join(plans)
+
+
+def test_exact_contract_search_uses_index(run):
+    async def scenario():
+        await _populate()
+        return await _plans(lambda session: SearchRepo(session).records("4-1005-3", 10))
+
+    plans = run(scenario)
+    assert not any(_SCAN_RECORDS.search(line) for line in plans), "\n".join(plans)
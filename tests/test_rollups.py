@@ -0,0 +1,114 @@
+from sqlalchemy import case, false, func, select, true
+
+from bot.database.base import AsyncSessionLocal
+from bot.database.models import ROLES, MonthlyRollup, Record
+from bot.database.repositories import record_repo as record_repo_module
+from bot.database.repositories.record_repo import RecordRepo
+from bot.database.repositories.user_repo import UserRepo
+from bot.services.quota_service import QuotaService
+
+
+async def _rollups() -> dict[tuple[str, int], tuple[int, int]]:
+    """monthly_rollups без пустых строк: {(месяц, сотрудник): (активных, возвратов)}."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(MonthlyRollup.month, MonthlyRollup.user_id, MonthlyRollup.active, MonthlyRollup.returned)
+            .where((MonthlyRollup.active != 0) | (MonthlyRollup.returned != 0))
+        )
+        return {(month, user_id): (active, returned) for month, user_id, active, returned in result.all()}
+
+
+async def _from_records() -> dict[tuple[str, int], tuple[int, int]]:
+    """То же, посчитанное по сырой таблице records."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(
+                Record.month,
+                Record.user_id,
+                func.sum(case((Record.is_cancelled == false(), 1), else_=0)),
+                func.sum(case((Record.is_cancelled == true(), 1), else_=0)),
+            )
+            .group_by(Record.month, Record.user_id)
+        )
+        return {(month, user_id): (active, returned) for month, user_id, active, returned in result.all()}
+
+
+def test_rollups_follow_records(run, monkeypatch):
+    months = iter(["2026-01", "2026-01", "2026-02", "2026-02", "2026-02", "2026-03"])
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            user_repo = UserRepo(session)
+            for telegram_id in (10, 20, 30):
+                await user_repo.create(telegram_id, f"Сотрудник {telegram_id}", "+79000000000", ROLES[0])
+            await session.commit()
+
+        # Выдачи в разные месяцы: create и create_within_limit берут месяц из _current_month
+        ids = []
+        async with AsyncSessionLocal() as session:
+            repo = RecordRepo(session)
+            with monkeypatch.context() as m:
+                m.setattr(record_repo_module, "_current_month", lambda: next(months))
+                for user_id, site in [(10, "1"), (20, "2"), (10, "3"), (20, "4"), (30, "5"), (10, "6")]:
+                    ids.append((await repo.create(user_id, site)).id)
+            await session.commit()
+        async with AsyncSessionLocal() as session:
+            snapshot = await UserRepo(session).get_snapshot(30)
+            await QuotaService(session).take(snapshot, "7")
+            await session.commit()
+
+        # Возвраты, в том числе повторный (не должен считаться дважды)
+        async with AsyncSessionLocal() as session:
+            repo = RecordRepo(session)
+            await repo.cancel(ids[0])
+            await repo.cancel(ids[2])
+            await repo.cancel(ids[2])
+            await session.commit()
+        after_cancel = await _rollups(), await _from_records()
+
+        # Удаление сотрудника убирает его записи и итоги каскадом
+        async with AsyncSessionLocal() as session:
+            await UserRepo(session).delete(20)
+            await session.commit()
+        after_delete = await _rollups(), await _from_records()
+
+        async with AsyncSessionLocal() as session:
+            mismatched = await RecordRepo(session).rebuild_rollups()
+            await session.commit()
+        return after_cancel, after_delete, mismatched, await _rollups()
+
+    after_cancel, after_delete, mismatched, rebuilt = run(scenario)
+
+    rollups, records = after_cancel
+    assert rollups == records
+    assert rollups[("2026-01", 10)] == (0, 1)
+    assert rollups[("2026-02", 10)] == (0, 1)
+    rollups, records = after_delete
+    assert rollups == records
+    assert not any(user_id == 20 for _, user_id in rollups)
+    assert mismatched == 0
+    assert rebuilt == rollups
+
+
+def test_rebuild_fixes_drifted_rollups(run):
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            await UserRepo(session).create(10, "Сотрудник", "+79000000000", ROLES[0])
+            repo = RecordRepo(session)
+            await repo.create(10, "1")
+            await repo.create(10, "2")
+            await session.commit()
+        async with AsyncSessionLocal() as session:
+            # Правка в обход бота
+            await session.execute(MonthlyRollup.__table__.update().values(active=MonthlyRollup.active + 5))
+            await session.commit()
+        async with AsyncSessionLocal() as session:
+            repo = RecordRepo(session)
+            first = await repo.rebuild_rollups()
+            second = await repo.rebuild_rollups()
+            await session.commit()
+        return first, second, await _rollups(), await _from_records()
+
+    first, second, rollups, records = run(scenario)
+    assert (first, second) == (1, 0)
+    assert rollups == records
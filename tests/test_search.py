@@ -0,0 +1,28 @@
+from sqlalchemy import insert
+
+from bot.database.base import AsyncSessionLocal
+from bot.database.models import ROLES, Record
+from bot.database.repositories import search_repo
+from bot.database.repositories.search_repo import SearchRepo
+from bot.database.repositories.user_repo import UserRepo
+
+
+def test_exact_contract_found_beyond_rank_window(run):
+    """Точный номер находится, даже если совпадений по началу больше окна ранжирования."""
+    newer = search_repo._RECORDS_RANK_WINDOW + 100
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            await UserRepo(session).create(100, "Сотрудник", "+79000000000", ROLES[0])
+            rows = [{"site_number": "100"}] + [{"site_number": f"100{n}"} for n in range(newer)]
+            await session.execute(
+                insert(Record),
+                [{"user_id": 100, "month": "2026-01", "is_cancelled": False, **row} for row in rows],
+            )
+            await session.commit()
+            return await SearchRepo(session).records("100", 10)
+
+    hits = run(scenario)
+    assert [hit.site_number for hit in hits][:1] == ["100"]
+    assert len(hits) == 10
+    assert len({hit.id for hit in hits}) == 10
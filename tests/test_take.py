@@ -0,0 +1,108 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from sqlalchemy import func, select
+
+from bot.database.base import AsyncSessionLocal, LazySession
+from bot.database.models import ROLES, Record
+from bot.database.repositories.quota_repo import QuotaRepo
+from bot.database.repositories.record_repo import RecordRepo
+from bot.database.repositories.user_repo import UserRepo
+from bot.handlers.employee import take_confirm
+from bot.services.quota_service import QuotaService
+
+_PARALLEL = 20
+_LIMIT = 3
+
+
+async def _register(telegram_id: int, limit: int | None = None):
+    async with AsyncSessionLocal() as session:
+        user_repo = UserRepo(session)
+        await user_repo.create(telegram_id, f"Сотрудник {telegram_id}", "+79000000000", ROLES[0])
+        if limit is not None:
+            await QuotaRepo(session).set_personal_limit(telegram_id, limit)
+        await session.commit()
+        return await user_repo.get_snapshot(telegram_id)
+
+
+async def _take(user, site_number: str) -> Record | None:
+    # Каждое нажатие — отдельный апдейт со своей сессией и своим соединением
+    async with AsyncSessionLocal() as session:
+        record = await QuotaService(session).take(user, site_number)
+        await session.commit()
+        return record
+
+
+async def _stored(telegram_id: int) -> tuple[int, int]:
+    """(записей в records, использовано по monthly_rollups)."""
+    async with AsyncSessionLocal() as session:
+        records = await session.scalar(
+            select(func.count()).select_from(Record).where(Record.user_id == telegram_id)
+        )
+        return records, await RecordRepo(session).count_used(telegram_id)
+
+
+def test_parallel_takes_do_not_exceed_personal_limit(run):
+    async def scenario():
+        user = await _register(100, limit=_LIMIT)
+        results = await asyncio.gather(*(_take(user, f"12/{n}") for n in range(_PARALLEL)))
+        return sum(r is not None for r in results), *await _stored(100)
+
+    issued, records, used = run(scenario)
+    assert issued == records == used == _LIMIT
+
+
+def test_parallel_takes_by_many_users_respect_each_limit(run):
+    users_count = 5
+
+    async def scenario():
+        users = [await _register(200 + n) for n in range(users_count)]  # лимит по роли
+        async with AsyncSessionLocal() as session:
+            limit = await QuotaRepo(session).get_limit(users[0].telegram_id, users[0].role)
+        await asyncio.gather(*(
+            _take(user, f"{user.telegram_id}/{n}") for user in users for n in range(limit + 3)
+        ))
+        return limit, [await _stored(user.telegram_id) for user in users]
+
+    limit, stored = run(scenario)
+    assert stored == [(limit, limit)] * users_count
+
+
+def test_take_after_exhaustion_returns_none(run):
+    async def scenario():
+        user = await _register(300, limit=1)
+        first = await _take(user, "A-1")
+        second = await _take(user, "A-2")
+        return first, second, await _stored(300)
+
+    first, second, stored = run(scenario)
+    assert first is not None and first.site_number == "A-1"
+    assert second is None
+    assert stored == (1, 1)
+
+
+def test_take_commits_before_telegram_calls(run):
+    """Блокировка записи не держится, пока хендлер ждёт ответа Telegram."""
+    in_transaction: list[bool] = []
+
+    async def scenario():
+        user = await _register(400, limit=_LIMIT)
+        session = LazySession(AsyncSessionLocal)
+
+        async def edit_text(*args, **kwargs):
+            in_transaction.append(session.in_transaction())
+
+        callback = MagicMock()
+        callback.message.edit_text = edit_text
+        callback.message.answer = AsyncMock()
+        callback.answer = AsyncMock()
+        state = AsyncMock()
+        state.get_data.return_value = {"site_number": "12/1"}
+        try:
+            await take_confirm(callback, state, user, False, session)
+        finally:
+            await session.close()
+        return await _stored(400)
+
+    assert run(scenario) == (1, 1)
+    assert in_transaction == [False]